@@ -3,11 +3,12 @@
 from django.shortcuts import render_to_response
 from django.utils.translation import ugettext as _
 from django.template import RequestContext
-from django.core.mail import send_mail, EmailMessage
+from django.core.mail import EmailMessage
 from django.contrib.admin import helpers
 from django.conf import settings
 
 from coaching.forms import MailForm
+from coaching.courrier import envoie_plus_tard
 
 def send_email(modeladmin, request, queryset):
     """
@@ -26,20 +27,16 @@ def send_email(modeladmin, request, queryset):
             attach = None
             if 'attach' in request.FILES:
                 attach = request.FILES['attach']
-            try:
-                mail = EmailMessage(subject=subject,
-                        body=message,
-                        from_email=from_email,
-                        to=email_list,
-                        headers={'Reply-To': reply_to})
-                if attach:
-                    mail.attach(attach.name, attach.read(), attach.content_type)
-                mail.send()
-                request.user.message_set.create(
-                        message=_("The message has been sent."))
-            except:
-                request.user.message_set.create(
-                        message=_("Error: unable to send message."))
+            mail = EmailMessage(subject=subject,
+                    body=message,
+                    from_email=from_email,
+                    to=email_list,
+                    headers={'Reply-To': reply_to})
+            if attach:
+                mail.attach(attach.name, attach.read(), attach.content_type)
+            envoie_plus_tard([mail])
+            request.user.message_set.create(
+                    message=_("The message has been queued for sending."))
             return None
         else:
             return render_to_response('coaching/sendmailadmin.html',
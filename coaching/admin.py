@@ -7,8 +7,9 @@ from django.contrib.auth.models import User, Group
 from django import forms
 from django.forms import ModelForm
 from django.conf import settings
+from django.db.models import Count
 
-from coaching.models import Client, Groupe, Utilisateur, CoursDuGroupe, Event, Work, AutresDocs, Assistants, Prof
+from coaching.models import Client, Groupe, Utilisateur, CoursDuGroupe, Event, Work, AutresDocs, Assistants, Prof, Courrier
 from coaching.actions import send_email
 
 from listes import *
@@ -198,6 +199,16 @@ class UtilisateurAdmin(UserAdmin):
             return True
         return super(UtilisateurAdmin, self).lookup_allowed(lookup, *args, **kwargs)
 
+    def queryset(self, request):
+        """
+        Groupe et cours courant lus avec l'utilisateur, nombres de cours et
+        de devoirs du groupe calculés par la même requête
+        """
+        return super(UtilisateurAdmin, self).queryset(request).select_related(
+                'groupe', 'current').annotate(
+                nb_cours_groupe=Count('groupe__cours', distinct=True),
+                nb_works_groupe=Count('groupe__work', distinct=True))
+
     def derniere_cnx(self, obj):
         return obj.last_login.strftime('%Y-%m-%d')
     derniere_cnx.short_description = _('Last login')
@@ -218,7 +229,7 @@ class UtilisateurAdmin(UserAdmin):
     full_name.allow_tags = True
 
     def cours_valides(self, obj):
-        return "%s / %s" % (obj.nb_cours_valides, obj.groupe.cours.count())
+        return "%s / %s" % (obj.nb_cours_valides, obj.nb_cours_groupe)
     cours_valides.short_description = _('Completed courses')
     cours_valides.admin_order_field = 'nb_cours_valides'
 
@@ -229,7 +240,7 @@ class UtilisateurAdmin(UserAdmin):
 
     def travaux_rendus(self, obj):
         return "%s / %s" % (obj.nb_travaux_rendus,
-                Work.objects.filter(groupe=obj.groupe).count()) 
+                obj.nb_works_groupe)
     travaux_rendus.short_description = _('Uploaded assignments')
     travaux_rendus.admin_order_field = 'nb_travaux_rendus'
 
@@ -261,3 +272,14 @@ class ProfAdmin(admin.ModelAdmin):
     )
     list_filter = ('groupe',)
 admin.site.register(Prof, ProfAdmin)
+
+class CourrierAdmin(admin.ModelAdmin):
+    list_display = ('destinataire', 'sujet', 'statut', 'essais', 'cree',
+                    'envoye')
+    list_filter = ('statut',)
+    search_fields = ('destinataire', 'sujet')
+    date_hierarchy = 'cree'
+    readonly_fields = ('essais', 'erreur', 'cree', 'envoye')
+    # le corps des mails de logins contient le mot de passe
+    exclude = ('corps',)
+admin.site.register(Courrier, CourrierAdmin)
@@ -0,0 +1,165 @@
+# -*- encoding: utf-8 -*-
+"""
+Dépôt et archives zip des devoirs rendus.
+
+Le fichier déposé est écrit par blocs et signé (SHA-1) au fil de
+l'écriture, sans relecture.
+
+Les archives du groupe-cours (g<groupe>-<cours>.zip) et de l'utilisateur
+(g<groupe>-<login>.zip) ne sont plus conservées sur disque : elles sont
+construites à la demande en envoyant les devoirs rendus dans un flux zip
+(sans fichier temporaire). Les fichiers déjà compressés sont stockés tels
+quels, les autres sont compressés (deflate).
+
+Le format zip sans extension Zip64 est limité à 4 Go et 65535 fichiers :
+une archive plus grande est refusée (ArchiveTropGrande) avant le début
+de l'envoi.
+"""
+
+import os
+import time
+import struct
+import zlib
+import hashlib
+
+from django.core.files import File
+
+# taille des blocs lus (octets)
+BLOC = 64*1024
+
+# extensions des fichiers stockés sans compression
+STOCKES = ('.zip', '.docx', '.xlsx', '.pptx', '.odt', '.ods',
+           '.jpg', '.jpeg', '.png', '.gif', '.gz', '.rar', '.7z')
+
+# limites du format zip sans Zip64
+TAILLE_MAX = 0xFFFFFFFF
+ENTREES_MAX = 0xFFFF
+
+class ArchiveTropGrande(Exception):
+    """
+    L'archive dépasserait les limites du format zip
+    """
+
+class FichierSigne(File):
+    """
+    Fichier déposé dont les blocs sont hachés pendant leur lecture
+    """
+    def __init__(self, fichier):
+        super(FichierSigne, self).__init__(fichier, fichier.name)
+        self.sha = hashlib.sha1()
+
+    def chunks(self, chunk_size=None):
+        for bloc in self.file.chunks(chunk_size):
+            self.sha.update(bloc)
+            yield bloc
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+def nom_archive(groupe_id, suffixe):
+    """
+    Nom de l'archive du groupe pour un cours (slug) ou un login
+    """
+    return 'g%d-%s.zip' % (groupe_id, suffixe)
+
+def _dos(date):
+    """
+    (heure, date) au format MS-DOS
+    """
+    if date is None or date.year < 1980:
+        date = time.localtime()
+        date = (date.tm_year, date.tm_mon, date.tm_mday,
+                date.tm_hour, date.tm_min, date.tm_sec)
+    else:
+        date = (date.year, date.month, date.day,
+                date.hour, date.minute, date.second)
+    return (date[3] << 11 | date[4] << 5 | date[5] // 2,
+            (date[0] - 1980) << 9 | date[1] << 5 | date[2])
+
+def zip_flux(fichiers):
+    """
+    Générateur d'une archive zip
+    fichiers : itérable de (chemin, nom dans l'archive, date)
+    Les fichiers illisibles sont ignorés. Les tailles et CRC suivent les
+    données de chaque fichier (descripteur de données, bit 3).
+    """
+    central = []
+    position = 0
+    for chemin, nom, date in fichiers:
+        try:
+            f = open(chemin, 'rb')
+        except IOError:
+            continue
+        try:
+            if isinstance(nom, unicode):
+                nom = nom.encode('utf-8')
+            if os.path.splitext(nom)[1].lower() in STOCKES:
+                methode, z = 0, None
+            else:
+                methode, z = 8, zlib.compressobj(6, zlib.DEFLATED, -15)
+            flags = 0x08 | 0x800
+            heure, jour = _dos(date)
+            entete = struct.pack('<4s5H3L2H', 'PK\x03\x04', 20, flags,
+                    methode, heure, jour, 0, 0, 0, len(nom), 0) + nom
+            yield entete
+            crc = taille = compresse = 0
+            while True:
+                bloc = f.read(BLOC)
+                if not bloc:
+                    break
+                crc = zlib.crc32(bloc, crc)
+                taille += len(bloc)
+                if z:
+                    bloc = z.compress(bloc)
+                if bloc:
+                    compresse += len(bloc)
+                    yield bloc
+            if z:
+                bloc = z.flush()
+                compresse += len(bloc)
+                yield bloc
+        finally:
+            f.close()
+        crc &= 0xffffffff
+        yield struct.pack('<4s3L', 'PK\x07\x08', crc, compresse, taille)
+        if compresse > TAILLE_MAX or taille > TAILLE_MAX or \
+                position + len(entete) + compresse + 16 > TAILLE_MAX:
+            # fichier grossi depuis verifie_taille : archive inutilisable
+            raise ArchiveTropGrande(nom)
+        central.append(struct.pack('<4s6H3L5H2L', 'PK\x01\x02', 20, 20,
+                flags, methode, heure, jour, crc, compresse, taille,
+                len(nom), 0, 0, 0, 0, 0, position) + nom)
+        position += len(entete) + compresse + 16
+    repertoire = ''.join(central)
+    yield repertoire
+    yield struct.pack('<4s4H2LH', 'PK\x05\x06', 0, 0, len(central),
+            len(central), len(repertoire), position, 0)
+
+def verifie_taille(fichiers):
+    """
+    Lève ArchiveTropGrande si l'archive des fichiers (chemin, nom, date)
+    dépasserait les limites du format zip.
+    La taille est majorée : en-têtes, répertoire et expansion possible
+    de deflate sur les données incompressibles.
+    """
+    if len(fichiers) > ENTREES_MAX:
+        raise ArchiveTropGrande(len(fichiers))
+    total = 22
+    for chemin, nom, date in fichiers:
+        try:
+            taille = os.path.getsize(chemin)
+        except OSError:
+            continue
+        total += taille + taille // 1000 + 128 + 2 * len(nom)
+    if total > TAILLE_MAX:
+        raise ArchiveTropGrande(total)
+
+def zip_workdone(workdones):
+    """
+    Générateur de l'archive zip des devoirs rendus.
+    Lève ArchiveTropGrande si l'archive est trop grande.
+    """
+    fichiers = [(wd.fichier.path, os.path.basename(wd.fichier.name), wd.date)
+                for wd in workdones]
+    verifie_taille(fichiers)
+    return zip_flux(fichiers)
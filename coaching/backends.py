@@ -1,33 +1,80 @@
 # -*- encoding: utf-8 -*-
 
+import time
 import datetime
+import logging
 
 from email_auth.backends import EmailBackend
 
+from coaching.motdepasse import a_rehacher
+
+# durées de chaque connexion (requête, hachage, total), niveau DEBUG
+logger = logging.getLogger('coaching.backends')
+
 class Backend(EmailBackend):
     """
     Email authentication backend
-    This relies on my email-auth backend, and adds the 
+    This relies on my email-auth backend, and adds the
     masquerading (see http://www.djangosnippets.org/snippets/1590/)
+    The user is read with its group in one query (index on
+    auth_user.email, see sql/utilisateur.sql). A password hashed by
+    another algorithm than coaching.motdepasse.ALGORITHME is hashed
+    again on login.
     """
     def authenticate(self, email=None, password=None):
-        try:
-            user = self.user_class.objects.get(email=email)
-        except self.user_class.DoesNotExist:
+        debut = time.time()
+        mesures = {'requete': 0., 'hachage': 0.}
+        user = self._authenticate(email, password, mesures)
+        # pas d'adresse dans les logs
+        logger.debug('login %s: user %s, query %.1f ms, hash %.1f ms, '
+                     'total %.1f ms', user and 'ok' or 'failed',
+                     user and user.id or '-',
+                     mesures['requete'] * 1000, mesures['hachage'] * 1000,
+                     (time.time() - debut) * 1000)
+        return user
+
+    def _authenticate(self, email, password, mesures):
+        user = self._lit(mesures, email=email)
+        if user is None or password is None:
             return None
-        if user.check_password(password):
+        if self._verifie(user, password, mesures):
             if user.fermeture and user.fermeture < datetime.datetime.now():
                 user.is_active = False
             return user
         elif '/' in password:
             fake_user = user
             (email, password) = password.split('/', 1)
-            try:
-                user = self.user_class.objects.get(email=email)
-            except self.user_class.DoesNotExist:
-                return None
-            if user.check_password(password) and user.groupe.nom=='Staff':
+            user = self._lit(mesures, email=email, groupe__nom='Staff')
+            if user and self._verifie(user, password, mesures):
                 return fake_user
         return None
 
+    def _lit(self, mesures, **criteres):
+        debut = time.time()
+        try:
+            return self.user_class.objects.select_related('groupe').get(
+                    **criteres)
+        except self.user_class.DoesNotExist:
+            return None
+        finally:
+            mesures['requete'] += time.time() - debut
+
+    def _verifie(self, user, password, mesures):
+        debut = time.time()
+        try:
+            if not user.check_password(password):
+                return False
+            if a_rehacher(user.password):
+                user.set_password(password)
+                self.user_class.objects.filter(id=user.id).update(
+                        password=user.password)
+            return True
+        finally:
+            mesures['hachage'] += time.time() - debut
 
+    def get_user(self, user_id):
+        try:
+            return self.user_class.objects.select_related('groupe').get(
+                    pk=user_id)
+        except self.user_class.DoesNotExist:
+            return None
@@ -5,10 +5,15 @@ import datetime
 from django.utils.translation import ugettext as _
 #from django.core.cache import cache
 from django.conf import settings
+from django.core import urlresolvers
+from django.core.cache import cache
+from django.db.models import Count
 
-from coaching.models import Utilisateur, ModuleValide, Resultat, Work, WorkDone, CoursDuGroupe, Prof, AutresDocs
+from coaching.models import Utilisateur, ModuleValide, Resultat, Work, WorkDone, CoursDuGroupe, Prof, AutresDocs, Progression
 from learning.controllers import UserModule, UserCours
 from learning.models import Cours
+from learning.progress import GroupeProgress, user_progress
+from coaching.archives import nom_archive
 
 class ProfCours(object):
     """
@@ -21,12 +26,25 @@ class ProfCours(object):
         self.nb_modules = len(self.cours.liste_modules())
         self.titre = gcp.cours.titre(prof.langue)
 
+    def workdone(self):
+        """
+        Return course assignments to download,
+        as a list of dict (zip name and url)
+        """
+        if not WorkDone.objects.filter(utilisateur__groupe=self.groupe,
+                work__cours=self.cours).exists():
+            return []
+        return [{'nom': nom_archive(self.groupe.id, self.cours.slug),
+                 'url': urlresolvers.reverse('coaching.views.workdone_cours',
+                     args=[self.groupe.id, self.cours.id])}]
+
     def users(self):
         """
         Return cours users
         """
-        return [UserState(u, self.cours) for u in
-                Utilisateur.objects.filter(groupe=self.groupe)]
+        matrice = GroupeProgress(self.groupe,
+                Utilisateur.objects.filter(groupe=self.groupe))
+        return [UserState(u, self.cours) for u in matrice.users]
 
 def filters(admin, groupe, selected=None):
     """
@@ -56,6 +74,7 @@ class AdminGroupe(object):
     """
     def __init__(self, admin, groupe, selection=None):
         self._users = -1
+        self._matrice = None
         self.admin = admin
         self.groupe = groupe
         self.selection = selection
@@ -75,40 +94,61 @@ class AdminGroupe(object):
         Return active groups users, as list of dict
         """
         if self._users == -1:
-            lookup = {'groupe': self.groupe,}
             if self.selection:
-                lookup.update(self.selection)
-            self._users = [UserState(u) for u in
-                    Utilisateur.objects.filter(is_active=1).filter(**lookup)]
+                # sélection sur les compteurs stockés (voir Progression) :
+                # tenus à jour par les signaux, sauf les retards et le
+                # cours courant, qui dépendent de la date et ne sont
+                # recalculés que par recalcule_progression (chaque nuit).
+                # Ce sont eux qui sont affichés, cohérents avec le filtre.
+                matrice = GroupeProgress(self.groupe,
+                        Utilisateur.objects.filter(groupe=self.groupe,
+                            is_active=1, **self.selection))
+            else:
+                matrice = self.matrice()
+            self._users = []
+            for u in matrice.users:
+                if not self.selection:
+                    matrice.applique(u)
+                self._users.append(UserState(u))
         return self._users
 
+    def matrice(self):
+        """
+        GroupeProgress des utilisateurs actifs du groupe
+        """
+        if self._matrice is None:
+            self._matrice = GroupeProgress(self.groupe,
+                    Utilisateur.objects.filter(groupe=self.groupe,
+                                               is_active=1))
+        return self._matrice
+
     def filtres(self):
         """
-        Filtres applicables à ce groupe
+        Filtres applicables à ce groupe : (cours courant, nb de modules
+        validés) des utilisateurs actifs, lus dans Progression
         """
-        courants = list(set(
-            [(u.cours_courant().cours, u.nb_modules_valides_in_current())
-            for u in self.users() if u.cours()]))
-        tous_les_cours = list(self.groupe.cours.order_by('coursdugroupe__rang'))
-        for c in courants:
-            c[0].rang = tous_les_cours.index(c[0])
-        courants.sort(key=lambda x: (x[0].rang,x[1]))
-        return courants
+        courants = sorted(set(Progression.objects.filter(
+                groupe=self.groupe, courant=True,
+                utilisateur__is_active=1).values_list(
+                        'rang', 'cours', 'nb_valides')))
+        cours = Cours.objects.in_bulk(set([c[1] for c in courants]))
+        for rang, cours_id, nb in courants:
+            cours[cours_id].rang = rang
+        return [(cours[cours_id], nb) for rang, cours_id, nb in courants]
 
     def workdone(self):
         """
         Return group assignments to download,
-        as a list of zipfiles
-        """
-        import os.path
-        lworkdone = []
-        for c in self.groupe.cours.all():
-            zipname = 'g%d-%s.zip' % (self.groupe.id, c.slug)
-            zipfile = os.path.join(settings.MEDIA_ROOT,
-                    settings.WORKDONE_DIR,zipname)
-            if os.path.exists(zipfile):
-                lworkdone.append(zipname)
-        return lworkdone
+        as a list of dict (zip name and url)
+        """
+        cours_ids = set(WorkDone.objects.filter(
+                utilisateur__groupe=self.groupe).values_list(
+                        'work__cours', flat=True))
+        return [{'nom': nom_archive(self.groupe.id, c.slug),
+                 'url': urlresolvers.reverse('coaching.views.workdone_cours',
+                     args=[self.groupe.id, c.id])}
+                for c in self.groupe.cours.order_by('coursdugroupe__rang')
+                if c.id in cours_ids]
 
     def courant(self):
         """
@@ -137,13 +177,91 @@ class AdminGroupe(object):
         """
         if self._nb_users_pb==-1:
             datelimite = datetime.datetime.now()-datetime.timedelta(7)
-            self._nb_users_pb = Utilisateur.objects.filter(
+            self._nb_users_pb = Progression.objects.filter(
                     groupe=self.groupe,
-                    nb_actuel__gt=0,
-                    last_login__lt=datelimite,
-                    ).count()
+                    valide=None,
+                    fin__lt=datetime.datetime.now(),
+                    utilisateur__last_login__lt=datelimite,
+                    ).values('utilisateur').distinct().count()
         return self._nb_users_pb
 
+class ApercuGroupes(object):
+    """
+    Vue d'ensemble de groupes (tableau de bord staff).
+    Chaque colonne est calculée pour tous les groupes par une requête
+    groupée ; les lignes sont conservées DUREE secondes dans le cache,
+    triées et paginées ensuite.
+    """
+    DUREE = getattr(settings, 'STAFF_DASHBOARD_TIMEOUT', 60)
+    TRIS = ('nom', 'is_open', 'is_demo', 'courant', 'nb_logins',
+            'nb_cours', 'nb_works', 'nb_users_pb')
+
+    def __init__(self, admin, groupes, cle='apercu_groupes'):
+        self.admin = admin
+        self.groupes = groupes
+        self.cle = '%s.%s' % (cle, admin.langue)
+
+    def lignes(self, tri='nom'):
+        """
+        Lignes (dict) triées sur tri, un des TRIS précédé de '-'
+        pour un tri décroissant
+        """
+        lignes = cache.get(self.cle)
+        if lignes is None:
+            lignes = self.calcule()
+            cache.set(self.cle, lignes, self.DUREE)
+        champ = tri.lstrip('-')
+        if champ not in self.TRIS:
+            champ, tri = 'nom', 'nom'
+        if champ == 'courant':
+            cle = lambda l: l['courant'] and l['courant']['titre'] or u''
+        else:
+            cle = lambda l: l[champ]
+        return sorted(lignes, key=cle, reverse=tri.startswith('-'))
+
+    def calcule(self):
+        """
+        Colonnes de tous les groupes, une requête par colonne
+        """
+        now = datetime.datetime.now()
+        datelimite = now - datetime.timedelta(7)
+        groupes = list(self.groupes.values('id', 'nom', 'is_open', 'is_demo'))
+        ids = [g['id'] for g in groupes] or [0]
+        nb_logins = dict(Utilisateur.objects.filter(groupe__in=ids
+                ).values_list('groupe').annotate(Count('groupe')))
+        nb_cours = dict(CoursDuGroupe.objects.filter(groupe__in=ids
+                ).values_list('groupe').annotate(Count('cours')))
+        nb_works = dict(Work.objects.filter(groupe__in=ids
+                ).values_list('groupe').annotate(Count('id')))
+        nb_users_pb = dict(Progression.objects.filter(groupe__in=ids,
+                valide=None, fin__lt=now,
+                utilisateur__last_login__lt=datelimite,
+                ).values_list('groupe').annotate(
+                        Count('utilisateur', distinct=True)))
+        # cours courant : le premier (rang) en cours à cette date
+        courants = {}
+        for groupe_id, cours_id in CoursDuGroupe.objects.filter(
+                groupe__in=ids, debut__lte=now, fin__gte=now).order_by(
+                'groupe', 'rang').values_list('groupe', 'cours'):
+            courants.setdefault(groupe_id, cours_id)
+        cours = Cours.objects.in_bulk(set(courants.values()))
+        lignes = []
+        for g in groupes:
+            courant = cours.get(courants.get(g['id']))
+            g.update({
+                'courant': courant and {
+                    'id': courant.id,
+                    'titre': courant.titre(self.admin.langue)},
+                'nb_logins': nb_logins.get(g['id'], 0),
+                'nb_cours': nb_cours.get(g['id'], 0),
+                'nb_works': nb_works.get(g['id'], 0),
+                'nb_users_pb': nb_users_pb.get(g['id'], 0),
+                'get_absolute_url': urlresolvers.reverse(
+                    'coaching.views.groupe', args=[str(g['id'])]),
+                })
+            lignes.append(g)
+        return lignes
+
 class UserState(object):
     """
     Controller d'un utilisateur avec état des performances
@@ -163,8 +281,9 @@ class UserState(object):
 
     def cours(self):
         if not self._cours:
-            self._cours = [UserCours(self.user, c)
-                for c in self.user.groupe.cours.order_by('coursdugroupe__rang')]
+            progress = user_progress(self.user)
+            self._cours = [UserCours(self.user, c, progress)
+                for c in progress.liste_cours]
         return self._cours
 
     def recalcule_tout(self, sauver=True):
@@ -172,13 +291,8 @@ class UserState(object):
         Recalcule tous les éléments de performance
         stockés de l'utilisateur
         """
-        self.nb_travaux_rendus(recalcul=True, sauve=False)
-        self.nb_cours_valides(recalcul=True, sauve=False)
-        self.nb_cours_en_retard(recalcul=True, sauve=False)
-        self.nb_cours_valides_en_retard(recalcul=True, sauve=False)
-        self.cours_courant(recalcul=True,sauve=False)
-        self.nb_modules_in_current(recalcul=True,sauve=False)
-        self.nb_modules_valides_in_current(recalcul=True,sauve=False)
+        for key, value in user_progress(self.user).compteurs().items():
+            setattr(self.user, key, value)
         if sauver:
             self.user.save()
 
@@ -187,7 +301,7 @@ class UserState(object):
         Retourne le nombre de cours auxquels l'utilisateur est inscrit
         """
         if not self._nb_cours:
-            self._nb_cours = self.user.groupe.cours.count()
+            self._nb_cours = len(user_progress(self.user).liste_cours)
         return self._nb_cours
 
     def nb_cours_valides(self, recalcul=False, sauve=True):
@@ -228,7 +342,7 @@ class UserState(object):
         Retourne le nombre de travaux à rendre par cet utilisateur
         """
         if not self._nb_travaux:
-            self._nb_travaux = Work.objects.filter(groupe=self.user.groupe).count()
+            self._nb_travaux = user_progress(self.user).nb_works()
         return self._nb_travaux
 
     def nb_travaux_rendus(self, recalcul=False, sauve=True):
@@ -238,7 +352,7 @@ class UserState(object):
         """
         if self.user.nb_travaux_rendus is None or recalcul:
             self.user.nb_travaux_rendus = \
-                    WorkDone.objects.filter(utilisateur=self.user).count()
+                    len(user_progress(self.user).works_done)
             if sauve:
                 self.user.save()
         return self.user.nb_travaux_rendus
@@ -279,6 +393,15 @@ class UserState(object):
                 return ucs[-1]
         return UserCours(self.user, self.user.current)
 
+    def cours_calcule(self):
+        """
+        UserCours courant calculé sur la progression, sans lire ni
+        écrire Utilisateur.current (tableau de bord étudiant)
+        """
+        progress = user_progress(self.user)
+        cours = progress.cours_courant()
+        return cours and UserCours(self.user, cours, progress)
+
     def nb_modules_valides(self):
         """
         Nb de module validés dans self.le_cours
@@ -346,15 +469,12 @@ class UserState(object):
 
     def workdone(self):
         """
-        Return user's assignments to download,
-        as a zipfile
+        Return url of user's assignments zip,
+        None if there are no assignments
         """
-        import os.path
-        zipname = 'g%d-%s.zip' % (self.user.groupe.id, self.user.username)
-        zipfile = os.path.join(settings.MEDIA_ROOT,
-                settings.WORKDONE_DIR,zipname)
-        if os.path.exists(zipfile):
-            return zipname
+        if WorkDone.objects.filter(utilisateur=self.user).exists():
+            return urlresolvers.reverse('coaching.views.workdone_user',
+                    args=[self.user.id])
 
 
 class AdminCours(object):
@@ -0,0 +1,182 @@
+# -*- encoding: utf-8 -*-
+"""
+File d'envoi des mails.
+
+Les vues ne parlent plus au serveur SMTP : envoie_plus_tard() enregistre
+un Courrier par destinataire (le message est personnalisé, chaque
+destinataire ne voit que son adresse). La commande envoie_courrier
+envoie la file par lots, sur une même connexion SMTP, avec un débit
+maximal ; un envoi échoué est retenté plus tard (délai doublé à chaque
+essai) jusqu'à ESSAIS essais, puis marqué en échec. Le statut de chaque
+courrier est visible dans l'admin ; le corps (identifiants des mails de
+logins) et la pièce jointe sont effacés une fois le courrier envoyé ou
+abandonné.
+
+Chaque courrier est réservé par un UPDATE conditionnel avant l'envoi
+(prochain repoussé de BAIL secondes) : plusieurs workers peuvent tourner
+sans envoyer deux fois le même courrier. Pour tester, un serveur SMTP de
+débogage affiche les messages au lieu de les envoyer :
+    python -m smtpd -n -c DebuggingServer localhost:1025
+avec EMAIL_HOST = 'localhost' et EMAIL_PORT = 1025.
+"""
+
+import time
+import datetime
+import smtplib
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+
+from coaching.models import Courrier
+
+# nombre de courriers lus et envoyés par connexion
+LOT = getattr(settings, 'MAIL_QUEUE_BATCH', 100)
+# débit maximal (mails par seconde, 0 : pas de limite)
+DEBIT = getattr(settings, 'MAIL_QUEUE_RATE', 0)
+# nombre d'essais avant abandon
+ESSAIS = getattr(settings, 'MAIL_QUEUE_RETRIES', 5)
+# délai avant le premier nouvel essai (secondes)
+DELAI = 60
+# durée de la réservation d'un courrier par un worker (secondes)
+BAIL = 10*60
+
+@transaction.commit_on_success
+def envoie_plus_tard(messages):
+    """
+    Place les messages (EmailMessage) dans la file d'envoi,
+    un Courrier par destinataire (to, cc et bcc)
+    Renvoie le nombre de courriers créés.
+    """
+    maintenant = datetime.datetime.now()
+    nb = 0
+    for message in messages:
+        piece = type_piece = ''
+        if message.attachments:
+            # une seule pièce jointe par message dans les formulaires
+            nom, contenu, type_piece = message.attachments[0]
+            fichier = Courrier._meta.get_field('piece_jointe')
+            piece = fichier.generate_filename(None, nom)
+            piece = fichier.storage.save(piece, ContentFile(contenu))
+        for destinataire in message.recipients():
+            Courrier.objects.create(expediteur=message.from_email,
+                    destinataire=destinataire,
+                    reply_to=message.extra_headers.get('Reply-To', ''),
+                    sujet=message.subject, corps=message.body,
+                    piece_jointe=piece, type_piece=type_piece or '',
+                    prochain=maintenant)
+            nb += 1
+    return nb
+
+def message(courrier):
+    """
+    EmailMessage du courrier
+    """
+    entetes = {}
+    if courrier.reply_to:
+        entetes['Reply-To'] = courrier.reply_to
+    mail = EmailMessage(subject=courrier.sujet, body=courrier.corps,
+            from_email=courrier.expediteur, to=[courrier.destinataire],
+            headers=entetes)
+    if courrier.piece_jointe:
+        courrier.piece_jointe.open('rb')
+        try:
+            mail.attach(courrier.piece_jointe.name.split('/')[-1],
+                    courrier.piece_jointe.read(),
+                    courrier.type_piece or None)
+        finally:
+            courrier.piece_jointe.close()
+    return mail
+
+def _reserve(courrier):
+    """
+    Réserve le courrier pour ce worker ; False si un autre l'a pris
+    """
+    bail = datetime.datetime.now() + datetime.timedelta(seconds=BAIL)
+    if not Courrier.objects.filter(id=courrier.id,
+            statut=Courrier.A_ENVOYER,
+            prochain=courrier.prochain).update(prochain=bail):
+        return False
+    courrier.prochain = bail
+    return True
+
+def _echec(courrier, erreur, essais, bilan):
+    """
+    Compte un essai échoué : nouvel essai plus tard ou abandon
+    """
+    courrier.essais += 1
+    courrier.erreur = unicode(erreur)
+    if courrier.essais >= essais:
+        courrier.statut = Courrier.ECHEC
+        bilan['abandons'] += 1
+    else:
+        courrier.prochain = datetime.datetime.now() + \
+                datetime.timedelta(seconds=DELAI * 2 ** (courrier.essais - 1))
+    bilan['erreurs'] += 1
+
+def _enregistre(courrier):
+    """
+    Enregistre le courrier ; le corps et la pièce jointe d'un courrier
+    envoyé ou abandonné sont effacés, le fichier quand plus aucun
+    courrier ne le référence
+    """
+    nom = ''
+    if courrier.statut != Courrier.A_ENVOYER:
+        nom = courrier.piece_jointe.name
+        courrier.corps = ''
+        courrier.piece_jointe = ''
+    courrier.save()
+    if nom and not Courrier.objects.filter(piece_jointe=nom).exists():
+        Courrier._meta.get_field('piece_jointe').storage.delete(nom)
+
+def envoie_file(lot=LOT, debit=DEBIT, essais=ESSAIS):
+    """
+    Envoie un lot de courriers à envoyer sur une connexion.
+    Renvoie le dict {'envoyes', 'erreurs', 'abandons'}.
+    """
+    maintenant = datetime.datetime.now()
+    courriers = list(Courrier.objects.filter(statut=Courrier.A_ENVOYER,
+            prochain__lte=maintenant).order_by('prochain', 'id')[:lot])
+    bilan = {'envoyes': 0, 'erreurs': 0, 'abandons': 0}
+    if not courriers:
+        return bilan
+    connexion = get_connection(fail_silently=False)
+    try:
+        connexion.open()
+    except Exception, e:
+        # serveur injoignable : un essai de plus pour tout le lot
+        for courrier in courriers:
+            if _reserve(courrier):
+                _echec(courrier, e, essais, bilan)
+                _enregistre(courrier)
+        return bilan
+    try:
+        for courrier in courriers:
+            if not _reserve(courrier):
+                continue
+            debut = time.time()
+            try:
+                try:
+                    connexion.send_messages([message(courrier)])
+                except smtplib.SMTPServerDisconnected:
+                    # le serveur a fermé la connexion : une nouvelle tentative
+                    connexion.close()
+                    connexion.open()
+                    connexion.send_messages([message(courrier)])
+            except Exception, e:
+                _echec(courrier, e, essais, bilan)
+            else:
+                courrier.essais += 1
+                courrier.statut = Courrier.ENVOYE
+                courrier.envoye = datetime.datetime.now()
+                courrier.erreur = ''
+                bilan['envoyes'] += 1
+            _enregistre(courrier)
+            if debit:
+                attente = 1. / debit - (time.time() - debut)
+                if attente > 0:
+                    time.sleep(attente)
+    finally:
+        connexion.close()
+    return bilan
@@ -0,0 +1,74 @@
+# -*- encoding: utf-8 -*-
+"""
+Droits des utilisateurs sur les groupes.
+
+La carte des droits d'un utilisateur est le couple des ensembles d'ids
+des groupes qu'il administre et de ceux qu'il peut consulter
+(administrés ou assistés). Elle est construite en une requête, conservée
+sur l'objet utilisateur pour la durée de la requête http et dans le cache
+entre les requêtes. Le cache porte une version commune, remplacée par
+les signaux de Assistants et de Groupe (changement d'administrateur,
+voir coaching.models) : les cartes de tous les utilisateurs sont alors
+reconstruites à leur prochaine lecture.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+# durée de vie des cartes dans le cache (secondes)
+DUREE = getattr(settings, 'PERMISSIONS_CACHE_TIMEOUT', 60*60)
+
+CLE_VERSION = 'droits.version'
+
+def cle(user_id):
+    return 'droits.%s' % user_id
+
+def carte(user):
+    """
+    Renvoie (ids administrés, ids visibles) de l'utilisateur
+    """
+    droits = getattr(user, '_droits', None)
+    if droits is not None:
+        return droits
+    lues = cache.get_many([CLE_VERSION, cle(user.id)])
+    version = lues.get(CLE_VERSION)
+    if version is None:
+        version = time.time()
+        cache.set(CLE_VERSION, version)
+    entree = lues.get(cle(user.id))
+    if entree and entree[0] == version:
+        droits = entree[1]
+    else:
+        from coaching.models import Groupe
+        admin, visibles = set(), set()
+        for groupe_id, admin_id in Groupe.objects.filter(
+                Q(administrateur=user.id) | Q(assistant=user.id)
+                ).values_list('id', 'administrateur').distinct():
+            visibles.add(groupe_id)
+            if admin_id == user.id:
+                admin.add(groupe_id)
+        droits = (frozenset(admin), frozenset(visibles))
+        cache.set(cle(user.id), (version, droits), DUREE)
+    user._droits = droits
+    return droits
+
+def groupes_admin(user):
+    """
+    Ids des groupes administrés par l'utilisateur
+    """
+    return carte(user)[0]
+
+def groupes_visibles(user):
+    """
+    Ids des groupes administrés ou assistés par l'utilisateur
+    """
+    return carte(user)[1]
+
+def invalide():
+    """
+    Invalide les cartes de tous les utilisateurs
+    """
+    cache.set(CLE_VERSION, time.time())
@@ -0,0 +1,129 @@
+# -*- encoding: utf-8 -*-
+"""
+Export csv des performances d'un ou plusieurs groupes.
+
+Le fichier est produit par un générateur, tranche d'utilisateurs par
+tranche d'utilisateurs : la mémoire utilisée ne dépend pas du nombre
+de lignes exportées.
+"""
+
+import csv
+import StringIO
+
+from django.utils.translation import ugettext as _
+
+from coaching.models import Utilisateur
+from learning.progress import GroupeStructure, GroupeProgress
+
+# nombre d'utilisateurs traités (et de lignes envoyées) à la fois
+TRANCHE = 500
+
+def _encode(s):
+    if s is None:
+        return ''
+    return unicode(s).encode("utf-8")
+
+def _structure(groupe, structures):
+    """
+    GroupeStructure du groupe, calculée une fois par export
+    """
+    if groupe.id not in structures:
+        structures[groupe.id] = GroupeStructure(groupe)
+    return structures[groupe.id]
+
+def entetes(groupes, structures=None):
+    """
+    Ligne d'en-tête du fichier.
+    Pour un seul groupe, les totaux du groupe figurent dans l'en-tête ;
+    pour plusieurs groupes, le groupe et ses totaux sont des colonnes.
+    structures : dict {groupe_id: GroupeStructure} partagé avec lignes()
+    """
+    if len(groupes) == 1:
+        structure = _structure(groupes[0],
+                structures is None and {} or structures)
+        return [_('Last Name'),
+                _('First Name'),
+                _('Email'),
+                _('Last login'),
+                _('Valid till'),
+                _('Completed courses / %d') % len(structure.liste_cours),
+                _('Uploaded works / %d') % structure.nb_works(),
+                _('Current course'),
+                _('Validated modules in current course'),
+                _('# modules in current course'),
+                _('Delays'),]
+    return [_('Group'),
+            _('Last Name'),
+            _('First Name'),
+            _('Email'),
+            _('Last login'),
+            _('Valid till'),
+            _('Completed courses'),
+            _('Uploaded works'),
+            _('Current course'),
+            _('Validated modules in current course'),
+            _('# modules in current course'),
+            _('Delays'),
+            _('# courses'),
+            _('# works'),]
+
+def lignes(groupes, structures=None):
+    """
+    Générateur des lignes (listes de valeurs) des utilisateurs actifs
+    des groupes, calculées par GroupeProgress
+    """
+    if structures is None:
+        structures = {}
+    plusieurs = len(groupes) > 1
+    for groupe in groupes:
+        structure = _structure(groupe, structures)
+        ids = list(Utilisateur.objects.filter(groupe=groupe,
+                is_active=1).values_list('id', flat=True))
+        for i in range(0, len(ids), TRANCHE):
+            users = Utilisateur.objects.filter(id__in=ids[i:i+TRANCHE])
+            matrice = GroupeProgress(groupe, users, structure)
+            for u in matrice.users:
+                col = matrice.colonnes[u.id]
+                if col['current']:
+                    courant = col['current'].titre(u.langue)
+                else:
+                    courant = ''
+                ligne = [u.last_name,
+                         u.first_name,
+                         u.email,
+                         u.last_login,
+                         u.fermeture,
+                         col['nb_cours_valides'],
+                         col['nb_travaux_rendus'],
+                         courant,
+                         col['nb_valides'],
+                         col['nb_modules'],
+                         col['nb_actuel'],]
+                if plusieurs:
+                    ligne.insert(0, groupe.nom)
+                    ligne.extend([len(structure.liste_cours),
+                                  structure.nb_works()])
+                yield ligne
+
+def csv_performances(groupes):
+    """
+    Renvoie un générateur du contenu csv (utf-8, séparateur ;),
+    envoyé par blocs de TRANCHE lignes.
+    L'en-tête est traduit tout de suite, dans la langue de la requête.
+    """
+    structures = {}
+    tampon = StringIO.StringIO()
+    writer = csv.writer(tampon, delimiter=';')
+    writer.writerow([_encode(s) for s in entetes(groupes, structures)])
+    return _blocs(tampon, writer, groupes, structures)
+
+def _blocs(tampon, writer, groupes, structures):
+    nb = 0
+    for ligne in lignes(groupes, structures):
+        writer.writerow([_encode(v) for v in ligne])
+        nb += 1
+        if nb % TRANCHE == 0:
+            yield tampon.getvalue()
+            tampon.seek(0)
+            tampon.truncate()
+    yield tampon.getvalue()
@@ -0,0 +1,230 @@
+# -*- encoding: utf-8 -*-
+"""
+Création de logins en masse à partir d'un fichier source.
+
+Le fichier source (nom, prénom, email séparés par des tabulations,
+iso-8859-1) est lu ligne à ligne, par tranches. Pour chaque tranche :
+- les emails et logins déjà utilisés sont cherchés en une requête
+- les mots de passe sont hachés, dans un pool de processus si demandé
+- les utilisateurs sont insérés par lots (un INSERT par table et par
+  lot, dans une transaction)
+- les mails d'identifiants sont placés dans la file d'envoi
+  (coaching.courrier)
+Les insertions contournent save() : aucun signal n'est envoyé, la
+progression des nouveaux utilisateurs est créée après chaque lot
+(learning.progress.maj_progression_groupe).
+"""
+
+import time
+import random
+import hashlib
+import datetime
+import multiprocessing
+
+from django.db import connection, transaction
+from django.db.models import Q, AutoField
+from django.contrib.auth.models import User
+from django.template.loader import render_to_string
+from django.core.mail import EmailMessage
+from django.utils.translation import ugettext as _
+
+from coaching.models import Utilisateur
+from coaching.courrier import envoie_plus_tard
+from coaching.motdepasse import hache
+from learning.progress import maj_progression_groupe
+
+# nombre de lignes par tranche
+TRANCHE = 500
+
+class LigneInvalide(ValueError):
+    """
+    Ligne du fichier source illisible
+    """
+
+def lit_source(lignes, entete=False):
+    """
+    Générateur des (nom, prénom, email) des lignes du fichier source
+    lignes : itérable de lignes (fichier, UploadedFile)
+    entete : ignorer les lignes précédant l'entête 'Nom<tab>'
+    Lève LigneInvalide si une ligne n'a pas trois colonnes.
+    """
+    for line in lignes:
+        if entete:
+            entete = not line.startswith('Nom\t')
+            continue
+        line = line.decode('iso-8859-1').strip()
+        if not line:
+            continue
+        try:
+            nom, prenom, email = line.split('\t')
+        except ValueError:
+            raise LigneInvalide(line)
+        yield nom.strip().title(), prenom.strip().title(), \
+                email.strip().lower()
+
+def ecrit_logins(fichier, logins):
+    """
+    Ecrit les identifiants des logins enregistrés (nom;prénom;email;mot
+    de passe, iso-8859-1). Les logins d'une tranche interrompue par une
+    erreur n'ont pas de statut et ne sont pas écrits.
+    """
+    fichier.write(';'.join(('Last name','First name','Email','Password','\n')))
+    for login in logins:
+        if 'password' in login and 'status' in login:
+            fichier.write(';'.join((login['nom'], login['prenom'],
+                    login['email'], login['password'], '\n')
+                    ).encode('iso-8859-1'))
+
+def mot_de_passe():
+    return hashlib.sha1(str(random.random())).hexdigest()[:8]
+
+def _init():
+    # nouvelle graine par processus, les mots de passe sont tirés au hasard
+    random.seed()
+
+def _insere(modele, objets):
+    """
+    Insère les objets en une requête (champs propres au modèle)
+    """
+    champs = [f for f in modele._meta.local_fields
+              if not isinstance(f, AutoField)]
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            qn(modele._meta.db_table),
+            ', '.join([qn(f.column) for f in champs]),
+            ', '.join(['%s'] * len(champs)))
+    connection.cursor().executemany(sql, [
+            [f.get_db_prep_save(f.pre_save(o, True), connection=connection)
+             for f in champs] for o in objets])
+
+class Provision(object):
+    """
+    Création des logins d'un groupe
+    processes : taille du pool de hachage (1 : pas de pool)
+    rapport : fonction appelée après chaque tranche avec le dict
+              {'lues', 'creees', 'duree'}
+    """
+    def __init__(self, groupe, langue, fermeture=None, envoi_mail=False,
+                 processes=1, tranche=TRANCHE, rapport=None):
+        self.groupe = groupe
+        self.langue = langue
+        self.fermeture = fermeture
+        self.envoi_mail = envoi_mail
+        self.processes = processes
+        self.tranche = max(tranche, 1)
+        self.rapport = rapport
+        self.logins = []
+        self.lues = self.creees = 0
+        self.duree = 0.
+        self._emails = set()
+        self._usernames = set()
+
+    def cree(self, source):
+        """
+        Crée les logins des (nom, prénom, email) de source
+        et renvoie la liste des logins (dict avec le statut)
+        """
+        debut = time.time()
+        pool = None
+        if self.processes > 1:
+            # les processus fils ne doivent pas partager la connexion
+            connection.close()
+            pool = multiprocessing.Pool(self.processes, _init)
+        try:
+            lignes = []
+            for ligne in source:
+                lignes.append(ligne)
+                if len(lignes) >= self.tranche:
+                    self._tranche(lignes, pool, debut)
+                    lignes = []
+            if lignes:
+                self._tranche(lignes, pool, debut)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        self.duree = time.time() - debut
+        return self.logins
+
+    def debit(self):
+        """
+        Logins créés par seconde
+        """
+        return self.creees / (self.duree or 1)
+
+    def _tranche(self, lignes, pool, debut):
+        emails = [l[2] for l in lignes]
+        usernames = [email.split('@')[0][:30] for email in emails]
+        for email, username in User.objects.filter(
+                Q(email__in=emails) | Q(username__in=usernames)
+                ).values_list('email', 'username'):
+            self._emails.add(email.lower())
+            self._usernames.add(username)
+        nouveaux = []
+        for (nom, prenom, email), username in zip(lignes, usernames):
+            login = {'nom': nom, 'prenom': prenom, 'email': email}
+            self.logins.append(login)
+            if email in self._emails:
+                login['status'] = _('Exists already.')
+            elif username in self._usernames:
+                login['status'] = _('Login exists already.')
+            else:
+                self._emails.add(email)
+                self._usernames.add(username)
+                login['username'] = username
+                login['password'] = mot_de_passe()
+                nouveaux.append(login)
+        if nouveaux:
+            mots = [l['password'] for l in nouveaux]
+            if pool:
+                haches = pool.map(hache, mots,
+                        max(len(mots) // self.processes, 1))
+            else:
+                haches = [hache(m) for m in mots]
+            ids = self._enregistre(nouveaux, haches)
+            for login in nouveaux:
+                login['status'] = _('Saved.')
+            maj_progression_groupe(self.groupe,
+                    Utilisateur.objects.filter(id__in=ids))
+            if self.envoi_mail:
+                envoie_plus_tard([self._mail(l) for l in nouveaux])
+                for login in nouveaux:
+                    login['status'] = ' '.join(
+                            (login['status'], _('Mail queued.')))
+        self.lues += len(lignes)
+        self.creees += len(nouveaux)
+        if self.rapport:
+            self.rapport({'lues': self.lues, 'creees': self.creees,
+                          'duree': time.time() - debut})
+
+    @transaction.commit_on_success
+    def _enregistre(self, nouveaux, haches):
+        maintenant = datetime.datetime.now()
+        users = [User(username=l['username'], last_name=l['nom'],
+                      first_name=l['prenom'], email=l['email'],
+                      password=h, last_login=maintenant,
+                      date_joined=maintenant)
+                 for l, h in zip(nouveaux, haches)]
+        _insere(User, users)
+        ids = dict(User.objects.filter(
+                username__in=[u.username for u in users]
+                ).values_list('username', 'id'))
+        _insere(Utilisateur, [
+                Utilisateur(user_ptr_id=ids[u.username], id=ids[u.username],
+                            fermeture=self.fermeture, langue=self.langue,
+                            groupe=self.groupe)
+                for u in users])
+        return ids.values()
+
+    def _mail(self, login):
+        g = self.groupe
+        mailmsg = render_to_string('coaching/mail_login.txt',
+                {'login': login['email'],
+                 'password': login['password'],
+                 'groupe': g.nom,
+                 'coach': g.administrateur.get_full_name(),
+                 'coach_mail': g.administrateur.email,})
+        return EmailMessage(subject='E-learning - %s' % g.client.nom,
+                            body=mailmsg,
+                            from_email='info@learngest.com',
+                            to=[login['email']])
@@ -0,0 +1,95 @@
+# -*- encoding: utf-8 -*-
+"""
+Mesure du nombre de requêtes et de la durée du calcul du tableau de
+groupe :
+- la matrice de progression (GroupeProgress) en fonction du nombre
+  d'utilisateurs
+- les chemins des vues du groupe sur le groupe entier : AdminGroupe.users,
+  filters et l'export csv
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection, reset_queries
+
+from coaching.models import Groupe, Utilisateur
+from coaching.controllers import AdminGroupe, filters
+from coaching.export import csv_performances
+from learning.progress import GroupeProgress
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--paliers', dest='paliers', default='1,10,100,1000',
+            help='Group sizes to measure, comma separated'),
+        make_option('--admin', dest='admin', type='int',
+            help='User id viewing the group (default: the group admin)'),
+    )
+    help = "Measure group progress matrix and group views query count and time"
+    args = '<groupe_id groupe_id ...>'
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Give at least one group id.')
+        try:
+            paliers = [int(p) for p in options['paliers'].split(',')]
+        except ValueError:
+            raise CommandError('--paliers must be a list of integers.')
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            for groupe_id in args:
+                try:
+                    groupe = Groupe.objects.get(id=groupe_id)
+                except Groupe.DoesNotExist:
+                    raise CommandError('Group %s does not exist.' % groupe_id)
+                users = list(Utilisateur.objects.filter(groupe=groupe))
+                print '%s (%d users)' % (groupe.nom, len(users))
+                tailles = [p for p in paliers if p < len(users)]
+                for taille in tailles + [len(users)]:
+                    self.mesure(groupe, users[:taille])
+                admin = self.admin(groupe, options['admin'])
+                if admin is None:
+                    print '  no admin to view the group, views skipped'
+                    continue
+                admin_groupe = AdminGroupe(admin, groupe)
+                self.chrono('AdminGroupe.users', admin_groupe.users)
+                self.chrono('filters',
+                        lambda: filters(admin, AdminGroupe(admin, groupe)))
+                self.chrono('csv export', lambda: ''.join(
+                        csv_performances([groupe])))
+        finally:
+            settings.DEBUG = debug
+
+    def mesure(self, groupe, users):
+        reset_queries()
+        debut = time.time()
+        matrice = GroupeProgress(groupe, users)
+        for u in matrice.users:
+            matrice.applique(u)
+        duree = time.time() - debut
+        print '  %5d users : %3d queries, %.3f s' % (
+            len(users), len(connection.queries), duree)
+
+    def admin(self, groupe, admin_id):
+        if admin_id:
+            try:
+                return Utilisateur.objects.get(id=admin_id)
+            except Utilisateur.DoesNotExist:
+                raise CommandError('User %s does not exist.' % admin_id)
+        if groupe.administrateur_id:
+            return groupe.administrateur
+        try:
+            return Utilisateur.objects.filter(is_staff=True)[0]
+        except IndexError:
+            return None
+
+    def chrono(self, nom, fonction):
+        reset_queries()
+        debut = time.time()
+        fonction()
+        duree = time.time() - debut
+        print '  %-17s : %3d queries, %.3f s' % (
+            nom, len(connection.queries), duree)
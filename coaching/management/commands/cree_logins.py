@@ -0,0 +1,94 @@
+# -*- encoding: utf-8 -*-
+"""
+Création des logins d'un groupe à partir d'un fichier source
+(nom, prénom, email séparés par des tabulations, iso-8859-1), pour les
+promotions de plusieurs milliers d'étudiants. Voir coaching.logins.
+"""
+
+import sys
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coaching.models import Groupe
+from coaching.logins import Provision, LigneInvalide, lit_source, \
+        ecrit_logins, TRANCHE
+
+from listes import LANGUAGES
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--langue', dest='langue', default='fr',
+            help='Preferred language of the users'),
+        make_option('--fermeture', dest='fermeture',
+            help='Expiration date (YYYY-MM-DD HH:MM)'),
+        make_option('--mail', dest='envoi_mail', action='store_true',
+            default=False, help='Send credentials by mail'),
+        make_option('--entete', dest='entete', action='store_true',
+            default=False, help="Skip lines before the 'Nom' header line"),
+        make_option('--processes', dest='processes', type='int',
+            default=multiprocessing.cpu_count(),
+            help='Number of password hashing processes (1: no pool)'),
+        make_option('--tranche', dest='tranche', type='int', default=TRANCHE,
+            help='Users per batch'),
+        make_option('--logins', dest='logins',
+            help='Write created logins and passwords to this file'),
+    )
+    help = "Create the logins of a group from a tab separated source file"
+    args = '<groupe_id> <source file>'
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Give a group id and a source file.')
+        try:
+            groupe = Groupe.objects.get(id=args[0])
+        except (Groupe.DoesNotExist, ValueError):
+            raise CommandError('Group %s does not exist.' % args[0])
+        if options['langue'] not in [l[0] for l in LANGUAGES]:
+            raise CommandError('Unknown language %s.' % options['langue'])
+        if not (options['logins'] or options['envoi_mail']):
+            raise CommandError('Give --logins or --mail, the passwords '
+                               'would be lost otherwise.')
+        verbosity = int(options.get('verbosity', 1))
+
+        def rapport(etat):
+            if verbosity > 0:
+                print '%(lues)d lines, %(creees)d logins, %(duree).1f s' % etat
+                sys.stdout.flush()
+
+        provision = Provision(groupe, options['langue'],
+                options['fermeture'], options['envoi_mail'],
+                options['processes'], options['tranche'], rapport)
+        try:
+            source = open(args[1])
+        except IOError, e:
+            raise CommandError(str(e))
+        try:
+            # tout le fichier est vérifié avant de créer le premier login
+            try:
+                for ligne in lit_source(source, options['entete']):
+                    pass
+            except LigneInvalide, e:
+                raise CommandError(
+                        'Invalid line: %s' % unicode(e).encode('utf-8'))
+            source.seek(0)
+            try:
+                logins = provision.cree(lit_source(source, options['entete']))
+            finally:
+                # identifiants des tranches créées, même après une erreur
+                if options['logins']:
+                    f = open(options['logins'], 'w')
+                    ecrit_logins(f, provision.logins)
+                    f.close()
+        finally:
+            source.close()
+        if verbosity > 1:
+            for login in logins:
+                print ('  %s: %s' % (login['email'], login['status'])
+                        ).encode('utf-8')
+        print '%d lines, %d logins created in %.1f s (%.0f logins/s)' % (
+                provision.lues, provision.creees, provision.duree,
+                provision.debit())
+        if options['envoi_mail'] and provision.creees:
+            print 'Credential mails queued, see envoie_courrier.'
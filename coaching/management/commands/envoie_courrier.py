@@ -0,0 +1,62 @@
+# -*- encoding: utf-8 -*-
+"""
+Envoi de la file des mails (voir coaching.courrier), une fois (cron)
+ou en boucle (--boucle).
+"""
+
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from coaching.courrier import envoie_file, LOT, DEBIT, ESSAIS
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--lot', dest='lot', type='int', default=LOT,
+            help='Mails sent per SMTP connection'),
+        make_option('--debit', dest='debit', type='float', default=DEBIT,
+            help='Maximum mails per second (0: no limit)'),
+        make_option('--essais', dest='essais', type='int', default=ESSAIS,
+            help='Attempts before a mail is marked as failed'),
+        make_option('--boucle', dest='boucle', action='store_true',
+            default=False, help='Keep running, waiting for new mails'),
+        make_option('--pause', dest='pause', type='float', default=10,
+            help='Seconds to wait when the queue is empty (with --boucle)'),
+    )
+    help = "Send the queued mails"
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        total = {'envoyes': 0, 'erreurs': 0, 'abandons': 0}
+        debut = time.time()
+        try:
+            while True:
+                lot = time.time()
+                bilan = envoie_file(options['lot'], options['debit'],
+                                    options['essais'])
+                for key in total:
+                    total[key] += bilan[key]
+                nb = bilan['envoyes'] + bilan['erreurs']
+                if nb and verbosity > 0:
+                    duree = time.time() - lot
+                    print '%d sent, %d errors, %d given up, ' \
+                          '%.1f s (%.1f mails/s)' % (bilan['envoyes'],
+                            bilan['erreurs'], bilan['abandons'], duree,
+                            nb / (duree or 1))
+                    sys.stdout.flush()
+                # file vide ou serveur injoignable : attente
+                if nb < options['lot'] or not bilan['envoyes']:
+                    if not options['boucle']:
+                        break
+                    # pas de connexion ouverte pendant l'attente
+                    connection.close()
+                    time.sleep(options['pause'])
+        except KeyboardInterrupt:
+            pass
+        if verbosity > 0:
+            print 'Total: %d sent, %d errors, %d given up in %.1f s' % (
+                    total['envoyes'], total['erreurs'], total['abandons'],
+                    time.time() - debut)
@@ -0,0 +1,196 @@
+# -*- encoding: utf-8 -*-
+"""
+Recalcul de la progression stockée (compteurs de Utilisateur et table
+Progression) de tous les utilisateurs, de ceux d'un client ou de ceux
+d'un groupe. Avec --marques, seuls les groupes marqués après une
+modification des modules ou des granules de leurs cours sont recalculés
+(voir learning.progress.marque_cours), à lancer fréquemment par cron.
+
+Les utilisateurs sont découpés en tranches d'un même groupe, réparties
+entre les processus d'un pool. Chaque tranche est lue en une requête
+par table (GroupeProgress) et les écritures sont regroupées : un UPDATE
+par ensemble de valeurs identiques.
+"""
+
+import time
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from coaching.models import Client, Groupe, Utilisateur, Progression
+from learning.progress import GroupeProgress, GroupeStructure, \
+        lignes_progression, groupes_marques, demarque, COMPTEURS
+
+# structures des groupes déjà chargées par le processus
+_structures = {}
+
+def _init():
+    # chaque processus du pool ouvre sa propre connexion
+    connection.close()
+
+def _structure(groupe_id):
+    if groupe_id not in _structures:
+        _structures[groupe_id] = GroupeStructure(
+                Groupe.objects.get(id=groupe_id))
+    return _structures[groupe_id]
+
+@transaction.commit_on_success
+def _ecrit(structure, maj_users, maj_lignes, nouvelles, supprimees):
+    cours = dict((c.id, c) for c in structure.liste_cours)
+    for valeurs, ids in maj_users.items():
+        valeurs = dict(valeurs)
+        valeurs['current'] = cours.get(valeurs['current'])
+        Utilisateur.objects.filter(id__in=ids).update(**valeurs)
+    for valeurs, ids in maj_lignes.items():
+        Progression.objects.filter(id__in=ids).update(**dict(valeurs))
+    for p in nouvelles:
+        p.save()
+    if supprimees:
+        Progression.objects.filter(id__in=supprimees).delete()
+
+def traite(tache):
+    """
+    Recalcule une tranche (groupe_id, ids des utilisateurs, dry_run).
+    Renvoie le dict des différences et du nombre d'écritures.
+    """
+    groupe_id, user_ids, dry_run = tache
+    structure = _structure(groupe_id)
+    matrice = GroupeProgress(structure.groupe,
+            Utilisateur.objects.filter(id__in=user_ids), structure)
+    existantes = {}
+    for p in Progression.objects.filter(utilisateur__in=user_ids):
+        existantes[(p.utilisateur_id, p.cours_id)] = p
+    diff = []
+    maj_users = {}
+    maj_lignes = {}
+    nouvelles = []
+    for u in matrice.users:
+        colonnes = matrice.colonnes[u.id]
+        nouveaux = [(k, getattr(colonnes[k], 'id', colonnes[k]))
+                    for k in COMPTEURS]
+        changes = [(k, getattr(u, k == 'current' and 'current_id' or k), v)
+                   for k, v in nouveaux]
+        changes = [c for c in changes if c[1] != c[2]]
+        if changes:
+            diff.append((u.username, changes))
+            maj_users.setdefault(tuple(nouveaux), []).append(u.id)
+        for cours_id, valeurs in lignes_progression(u._progress).items():
+            p = existantes.pop((u.id, cours_id), None)
+            if p is None:
+                nouvelles.append(Progression(utilisateur_id=u.id,
+                        groupe_id=groupe_id, cours_id=cours_id, **valeurs))
+            elif p.groupe_id != groupe_id or \
+                    [1 for k, v in valeurs.items() if getattr(p, k) != v]:
+                valeurs['groupe'] = groupe_id
+                maj_lignes.setdefault(tuple(sorted(valeurs.items())),
+                        []).append(p.id)
+    supprimees = [p.id for p in existantes.values()]
+    if not dry_run:
+        _ecrit(structure, maj_users, maj_lignes, nouvelles, supprimees)
+    return {
+        'users': len(matrice.users),
+        'diff': diff,
+        'updates': len(maj_users) + len(maj_lignes),
+        'modifiees': sum([len(ids) for ids in maj_lignes.values()]),
+        'creees': len(nouvelles),
+        'supprimees': len(supprimees),
+        }
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--client', dest='client', type='int',
+            help='Only users of this client id'),
+        make_option('--groupe', dest='groupes', type='int', action='append',
+            help='Only users of this group id (may be repeated)'),
+        make_option('--processes', dest='processes', type='int',
+            default=multiprocessing.cpu_count(),
+            help='Number of worker processes (1: no pool)'),
+        make_option('--tranche', dest='tranche', type='int', default=500,
+            help='Users per task'),
+        make_option('--marques', dest='marques', action='store_true',
+            default=False, help='Only the groups marked after a change '
+                                'of their course modules or granules'),
+        make_option('--dry-run', dest='dry_run', action='store_true',
+            default=False, help='Compute and report, write nothing'),
+    )
+    help = "Recompute stored progress counters and progress rows of users"
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        users = Utilisateur.objects.exclude(groupe=None)
+        if options['client']:
+            try:
+                client = Client.objects.get(id=options['client'])
+            except Client.DoesNotExist:
+                raise CommandError(
+                        'Client %s does not exist.' % options['client'])
+            users = users.filter(groupe__client=client)
+        if options['groupes']:
+            users = users.filter(groupe__in=options['groupes'])
+        marques = None
+        if options['marques']:
+            marques = groupes_marques()
+            if not marques:
+                if verbosity > 1:
+                    print 'No marked group.'
+                return
+            users = users.filter(groupe__in=marques)
+        tranche = max(options['tranche'], 1)
+        taches = []
+        courante = None
+        for groupe_id, user_id in users.order_by(
+                'groupe', 'id').values_list('groupe', 'id'):
+            if courante is None or courante[0] != groupe_id or \
+                    len(courante[1]) >= tranche:
+                courante = (groupe_id, [], options['dry_run'])
+                taches.append(courante)
+            courante[1].append(user_id)
+        nb_users = sum([len(t[1]) for t in taches])
+        if options['dry_run']:
+            print 'Dry run, nothing will be written.'
+        debut = time.time()
+        if options['processes'] > 1 and len(taches) > 1:
+            # les processus fils ne doivent pas partager la connexion
+            connection.close()
+            pool = multiprocessing.Pool(options['processes'], _init)
+            resultats = pool.imap_unordered(traite, taches)
+        else:
+            pool = None
+            resultats = (traite(t) for t in taches)
+        total = {'users': 0, 'updates': 0, 'modifiees': 0,
+                 'creees': 0, 'supprimees': 0}
+        champs = dict((k, 0) for k in COMPTEURS)
+        nb_changes = 0
+        try:
+            for resultat in resultats:
+                for key in total:
+                    total[key] += resultat[key]
+                for username, changes in resultat['diff']:
+                    nb_changes += 1
+                    for k, ancien, nouveau in changes:
+                        champs[k] += 1
+                    if verbosity > 1:
+                        print '  %s: %s' % (username, ', '.join(
+                            ['%s %s -> %s' % c for c in changes]))
+                if verbosity > 0:
+                    print '%d / %d users' % (total['users'], nb_users)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        duree = time.time() - debut
+        if marques and not options['dry_run']:
+            demarque(marques)
+        print '%d users in %.1f s (%.0f users/s), %d processes' % (
+                total['users'], duree, total['users'] / (duree or 1),
+                pool and options['processes'] or 1)
+        print '%d users with changed counters' % nb_changes
+        for k in COMPTEURS:
+            if champs[k]:
+                print '  %-18s %d' % (k, champs[k])
+        print '%d progress rows changed, %d created, %d deleted' % (
+                total['modifiees'], total['creees'], total['supprimees'])
+        if not options['dry_run']:
+            print '%d UPDATE statements' % total['updates']
@@ -6,6 +6,7 @@ Models de l'application coaching
 import datetime
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete, post_init
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User, UserManager
@@ -136,6 +137,35 @@ class CoursDuGroupe(models.Model):
     def __unicode__(self):
         return "%s - %s" % (self.groupe, self.cours)
 
+def invalide_index_modules(sender, instance, **kwargs):
+    """
+    Invalide l'index module -> cours du groupe (voir learning.progress)
+    """
+    from learning.progress import invalide_index_modules
+    invalide_index_modules(instance)
+
+def memorise_origine(sender, instance, **kwargs):
+    """
+    Mémorise le groupe d'origine, pour mettre à jour aussi l'ancien
+    groupe ; remis à jour par le dernier récepteur de post_save
+    """
+    from learning.progress import memorise_origine
+    memorise_origine(instance)
+
+def groupes_touches(instance):
+    """
+    Ids du groupe de l'instance et de son groupe d'origine
+    (voir memorise_origine)
+    """
+    groupes = set([instance.groupe_id,
+                   getattr(instance, '_groupe_origine', None)])
+    groupes.discard(None)
+    return groupes
+
+post_init.connect(memorise_origine, sender=CoursDuGroupe)
+post_save.connect(invalide_index_modules, sender=CoursDuGroupe)
+post_delete.connect(invalide_index_modules, sender=CoursDuGroupe)
+
 class Assistants(models.Model):
     """
     Assistant pour un groupe
@@ -235,17 +265,27 @@ class Utilisateur(User):
         return urlresolvers.reverse('admin:coaching_utilisateur_change',
                 args=(str(self.id),))
 
+    def set_password(self, raw_password):
+        if raw_password is None:
+            self.set_unusable_password()
+            return
+        from coaching.motdepasse import hache
+        self.password = hache(raw_password)
+
+    def check_password(self, raw_password):
+        from coaching.motdepasse import verifie
+        return verifie(raw_password, self.password)
+
     def may_see_groupe(self, grpe):
         """
         True si l'utilisateur peut consulter ce groupe
         """
+        from coaching.droits import groupes_visibles
         if self.is_staff:
             return True
-        if grpe.administrateur == self:
+        if grpe.administrateur_id == self.id:
             return True
-        if self in grpe.assistant.all():
-            return True
-        return False
+        return grpe.id in groupes_visibles(self)
 
     def may_admin_groupe(self, grpe):
         """
@@ -253,9 +293,7 @@ class Utilisateur(User):
         """
         if self.is_staff:
             return True
-        if grpe.administrateur == self:
-            return True
-        return False
+        return grpe.administrateur_id == self.id
 
     @models.permalink
     def get_absolute_url(self):
@@ -397,8 +435,9 @@ class AutresDocs(models.Model):
     def __unicode__(self):
         return u'%s - %s - %s' % (self.titre, self.groupe, self.cours)
 
+    @models.permalink
     def get_absolute_url(self):
-        return self.fichier.url
+        return('coaching.views.document', [str(self.id)])
 
 class Work(models.Model):
     """
@@ -443,3 +482,174 @@ class WorkDone(models.Model):
         return u'%s - %s - %s' % (self.utilisateur.email, 
                 self.work.titre, self.date)
 
+
+class Progression(models.Model):
+    """
+    Etat de progression d'un utilisateur dans un cours de son groupe.
+    Maintenu par les signaux des validations, des devoirs rendus et des
+    cours du groupe (voir learning.progress.maj_progression), il est lu
+    directement par les tableaux de bord et les filtres.
+    """
+    utilisateur = models.ForeignKey(Utilisateur)
+    groupe = models.ForeignKey(Groupe)
+    cours = models.ForeignKey(Cours)
+    rang = models.IntegerField()
+    fin = models.DateTimeField(blank=True, null=True, db_index=True)
+    # modules avec tests, et validés
+    nb_modules = models.IntegerField(default=0)
+    nb_valides = models.IntegerField(default=0)
+    # devoirs à rendre, et rendus
+    nb_travaux = models.IntegerField(default=0)
+    nb_rendus = models.IntegerField(default=0)
+    # date de validation du cours
+    valide = models.DateTimeField(blank=True, null=True, db_index=True)
+    courant = models.BooleanField(default=False, db_index=True)
+
+    class Meta:
+        ordering = ('utilisateur', 'rang')
+        unique_together = (('utilisateur', 'cours'),)
+
+    def __unicode__(self):
+        return u'%s - %s - %s/%s' % (self.utilisateur_id, self.cours_id,
+                self.nb_valides, self.nb_modules)
+
+class Courrier(models.Model):
+    """
+    Mail en attente d'envoi, un par destinataire (voir coaching.courrier)
+    """
+    A_ENVOYER, ENVOYE, ECHEC = 0, 1, 2
+    STATUTS = ((A_ENVOYER, _('To send')),
+               (ENVOYE, _('Sent')),
+               (ECHEC, _('Failed')))
+
+    expediteur = models.CharField(max_length=255)
+    destinataire = models.CharField(max_length=255)
+    reply_to = models.CharField(max_length=255, blank=True)
+    sujet = models.CharField(max_length=255)
+    # effacé une fois le courrier envoyé ou abandonné
+    corps = models.TextField()
+    # pièce jointe, partagée par les courriers d'un même message
+    piece_jointe = models.FileField(upload_to='courrier/%Y/%m/%d',
+            max_length=255, blank=True)
+    type_piece = models.CharField(max_length=100, blank=True)
+    statut = models.IntegerField(choices=STATUTS, default=A_ENVOYER,
+            db_index=True)
+    essais = models.IntegerField(default=0)
+    erreur = models.TextField(blank=True)
+    cree = models.DateTimeField(auto_now_add=True)
+    # date de la prochaine tentative
+    prochain = models.DateTimeField(db_index=True)
+    envoye = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ('-cree',)
+        verbose_name = _("Mail")
+        verbose_name_plural = _("Mails")
+
+    def __unicode__(self):
+        return u'%s - %s' % (self.destinataire, self.sujet)
+
+def maj_progression(sender, instance, **kwargs):
+    """
+    Met à jour la progression de l'utilisateur (voir learning.progress)
+    """
+    from learning.progress import maj_progression
+    try:
+        utilisateur = instance.utilisateur
+    except Utilisateur.DoesNotExist:
+        return
+    # suppression : l'utilisateur peut être en cours de suppression,
+    # on ne crée pas de lignes
+    maj_progression(utilisateur, creer='created' in kwargs)
+
+for model in (GranuleValide, ModuleValide, WorkDone):
+    post_save.connect(maj_progression, sender=model)
+    post_delete.connect(maj_progression, sender=model)
+
+def maj_progression_groupe(sender, instance, **kwargs):
+    """
+    Met à jour la progression des membres du groupe, et de l'ancien
+    groupe si le cours a changé de groupe
+    """
+    from learning.progress import maj_progression_groupe
+    for groupe in Groupe.objects.filter(id__in=groupes_touches(instance)):
+        # pas de nouvelles lignes après une suppression ni dans l'ancien
+        maj_progression_groupe(groupe, creer='created' in kwargs and
+                groupe.id == instance.groupe_id)
+
+post_save.connect(maj_progression_groupe, sender=CoursDuGroupe)
+post_delete.connect(maj_progression_groupe, sender=CoursDuGroupe)
+
+def memorise_groupe(sender, instance, **kwargs):
+    """
+    Mémorise le groupe de l'utilisateur tel que lu en base
+    """
+    instance._groupe_progression = instance.groupe_id
+
+def maj_progression_utilisateur(sender, instance, created, **kwargs):
+    """
+    Crée ou déplace la progression de l'utilisateur, à sa création
+    et quand il change de groupe
+    """
+    from learning.progress import maj_progression
+    if created or instance.groupe_id != getattr(instance,
+            '_groupe_progression', None):
+        maj_progression(instance)
+    instance._groupe_progression = instance.groupe_id
+
+post_init.connect(memorise_groupe, sender=Utilisateur)
+post_save.connect(maj_progression_utilisateur, sender=Utilisateur)
+
+def invalide_calendrier(sender, instance, **kwargs):
+    """
+    Invalide le calendrier du groupe, et de l'ancien groupe
+    (voir dashboard.planning)
+    """
+    from dashboard.planning import invalide_calendrier
+    for groupe_id in groupes_touches(instance):
+        invalide_calendrier(groupe_id)
+
+for model in (Event, CoursDuGroupe, Work):
+    post_save.connect(invalide_calendrier, sender=model)
+    post_delete.connect(invalide_calendrier, sender=model)
+
+def invalide_dashboard_utilisateur(sender, instance, **kwargs):
+    """
+    Invalide les fragments du tableau de bord de l'utilisateur
+    (voir dashboard.fragments)
+    """
+    from dashboard.fragments import invalide_utilisateur
+    invalide_utilisateur(instance.utilisateur_id)
+
+for model in (Resultat, GranuleValide, ModuleValide, WorkDone):
+    post_save.connect(invalide_dashboard_utilisateur, sender=model)
+    post_delete.connect(invalide_dashboard_utilisateur, sender=model)
+
+def invalide_dashboard_groupe(sender, instance, **kwargs):
+    """
+    Invalide les fragments du tableau de bord des membres du groupe,
+    et de l'ancien groupe
+    """
+    from dashboard.fragments import invalide_groupe
+    for groupe_id in groupes_touches(instance):
+        invalide_groupe(groupe_id)
+
+for model in (CoursDuGroupe, Event, Work, AutresDocs):
+    post_save.connect(invalide_dashboard_groupe, sender=model)
+    post_delete.connect(invalide_dashboard_groupe, sender=model)
+
+# en dernier : les récepteurs précédents lisent le groupe d'origine
+post_init.connect(memorise_origine, sender=Work)
+for model in (CoursDuGroupe, Work):
+    post_save.connect(memorise_origine, sender=model)
+
+def invalide_droits(sender, instance, **kwargs):
+    """
+    Invalide les droits sur les groupes (voir coaching.droits)
+    """
+    from coaching.droits import invalide
+    invalide()
+
+for model in (Assistants, Groupe):
+    post_save.connect(invalide_droits, sender=model)
+    post_delete.connect(invalide_droits, sender=model)
@@ -0,0 +1,76 @@
+# -*- encoding: utf-8 -*-
+"""
+Hachage des mots de passe des utilisateurs.
+
+Les mots de passe sont enregistrés au format de django, algo$sel$hash.
+Les nouveaux mots de passe sont hachés par settings.PASSWORD_ALGORITHM
+('sha1' par défaut, comme django). settings.PASSWORD_HASHERS ajoute des
+algorithmes : dict {nom: chemin de la fonction (sel, mot de passe) ->
+hash hexadécimal}. Un mot de passe haché par un autre algorithme est
+haché à nouveau à la connexion (voir coaching.backends).
+"""
+
+import random
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth.models import get_hexdigest, \
+        check_password as django_check_password
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import smart_str
+from django.utils.importlib import import_module
+
+ALGORITHME = getattr(settings, 'PASSWORD_ALGORITHM', 'sha1')
+
+_hacheurs = {}
+
+def hacheurs():
+    """
+    Renvoie le dict {algorithme: fonction (sel, mot de passe)}
+    """
+    if not _hacheurs:
+        for algo in ('sha1', 'md5'):
+            _hacheurs[algo] = lambda sel, password, algo=algo: \
+                    get_hexdigest(algo, sel, password)
+        for algo, chemin in getattr(settings, 'PASSWORD_HASHERS', {}).items():
+            module, fonction = chemin.rsplit('.', 1)
+            _hacheurs[algo] = getattr(import_module(module), fonction)
+    return _hacheurs
+
+def hache(password, algo=None):
+    """
+    Mot de passe haché (algo$sel$hash)
+    """
+    algo = algo or ALGORITHME
+    sel = get_hexdigest('sha1', str(random.random()), str(random.random()))[:5]
+    return '%s$%s$%s' % (algo, sel, hacheurs()[algo](sel, password))
+
+def verifie(password, encode):
+    """
+    True si password correspond au mot de passe haché encode,
+    False aussi pour un algorithme inconnu
+    """
+    if encode.count('$') == 2:
+        algo, sel, hsh = encode.split('$')
+        if algo in hacheurs():
+            return constant_time_compare(hsh,
+                    hacheurs()[algo](sel, password))
+    elif '$' not in encode:
+        if len(encode) != 32:
+            # mot de passe inutilisable
+            return False
+        # ancien md5 sans sel, haché à nouveau à la connexion
+        return constant_time_compare(encode,
+                hashlib.md5(smart_str(password)).hexdigest())
+    # crypt
+    try:
+        return django_check_password(password, encode)
+    except ValueError:
+        # algorithme inconnu (ou crypt indisponible)
+        return False
+
+def a_rehacher(encode):
+    """
+    True si le mot de passe n'est pas haché par l'algorithme courant
+    """
+    return encode.split('$', 1)[0] != ALGORITHME
@@ -0,0 +1,2 @@
+-- index des connexions par email (coaching.backends)
+CREATE INDEX auth_user_email ON auth_user (email);
@@ -8,6 +8,10 @@ urlpatterns = patterns('coaching.views',
     (r'^user/(?P<user_id>\d+)/$', 'user',),
     (r'^sendmail/$', 'sendmail',),
     (r'^upload/$', 'add_doc',),
+    (r'^documents/(?P<doc_id>\d+)/$', 'document',),
+    (r'^workdone/(?P<groupe_id>\d+)/(?P<cours_id>\d+)/$', 'workdone_cours',),
+    (r'^workdone/user/(?P<user_id>\d+)/$', 'workdone_user',),
     (r'^csv/$', 'csvperf',),
     (r'^dashboard/$', 'dashboard',),
+    (r'^ical/(?P<groupe_id>\d+)/(?P<user_id>\d+)-(?P<signature>[0-9a-f]+)\.ics$', 'ical',),
 )
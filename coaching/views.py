@@ -1,19 +1,30 @@
 # -*- encoding: utf-8 -*-
 
+import os
+
 from django.shortcuts import render_to_response
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, Http404, \
+        HttpResponseForbidden, HttpResponseNotModified
 from django.utils.translation import activate, ugettext as _
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.template import RequestContext
 from django.template.loader import render_to_string
 from django.core import urlresolvers
-from django.core.mail import send_mail, EmailMessage
+from django.core.mail import EmailMessage
 from django.conf import settings
+from django.utils.crypto import constant_time_compare
 
-from coaching.models import Utilisateur, Groupe, Prof, AutresDocs
+from coaching.models import Client, Utilisateur, Groupe, Prof, AutresDocs, CoursDuGroupe, WorkDone
 from coaching.forms import UtilisateurChangeForm, CreateLoginsForm, MailForm, DocumentForm
 from coaching.controllers import AdminGroupe, UserState, ProfCours, filters, AdminCours
-from dashboard.planning import Calendrier, Planning
+from coaching.export import csv_performances
+from coaching.archives import zip_workdone, nom_archive, ArchiveTropGrande
+from coaching.logins import Provision, LigneInvalide, lit_source, \
+        ecrit_logins
+from coaching.courrier import envoie_plus_tard
+from learning.controllers import UserCours
+from learning.telechargement import sert_fichier
+from dashboard.planning import Calendrier, Planning, signature_ical
 
 from listes import *
 
@@ -155,53 +166,154 @@ def dashboard(request):
 @login_required
 def csvperf(request):
     """
-    Download group performances as .csv file
+    Download group performances as .csv file.
+    ?id=<groupe_id> (may be repeated) or ?client=<client_id>
+    The file is streamed, block by block.
     """
-    import csv
     from django.template.defaultfilters import slugify
-    if 'id' in request.GET:
+    if 'client' in request.GET:
         try:
-            groupe = Groupe.objects.get(id=request.GET['id'])
-        except Groupe.DoesNotExist:
+            client = Client.objects.get(id=request.GET['client'])
+        except Client.DoesNotExist:
             request.user.message_set.create(
-                    message=_("This group does not exist."))
+                    message=_("This customer does not exist."))
             return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+        groupes = [g for g in Groupe.objects.filter(client=client)
+                if request.user.may_see_groupe(g)]
+        nom_fichier = 'client-%s.csv' % slugify(client.nom)
+    else:
+        groupes = list(Groupe.objects.filter(id__in=request.GET.getlist('id')))
+        if len(groupes) == 1:
+            nom_fichier = 'groupe-%s.csv' % slugify(groupes[0].nom)
+        else:
+            nom_fichier = 'groupes.csv'
+    if not groupes:
+        request.user.message_set.create(
+                message=_("This group does not exist."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    for groupe in groupes:
         if not request.user.may_see_groupe(groupe):
             request.user.message_set.create(
                 message=_(
                     "You do not have admin rights on the requested group."))
             return HttpResponseRedirect(LOGIN_REDIRECT_URL)
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = \
-            'attachment; filename=groupe-%s.csv' % slugify(groupe.nom)
-    writer = csv.writer(response,delimiter=';')
-    groupe = AdminGroupe(request.user, groupe)
-    writer.writerow([s.encode("utf-8") for s in [
-                    _('Last Name'),
-                    _('First Name'),
-                    _('Email'),
-                    _('Last login'),
-                    _('Valid till'),
-                    _('Completed courses / %d') % groupe.nb_cours,
-                    _('Uploaded works / %d') % groupe.nb_works,
-                    _('Current course'),
-                    _('Validated modules in current course'),
-                    _('# modules in current course'),
-                    _('Delays'),]])
-    for u in groupe.users():
-        writer.writerow([
-            u.user.last_name.encode("utf-8"),
-            u.user.first_name.encode("utf-8"),
-            u.email.encode("utf-8"),
-            u.last_login,
-            u.user.fermeture,
-            u.nb_cours_valides(),
-            u.nb_travaux_rendus(),
-            u.cours_courant().titre().encode("utf-8"),
-            u.nb_modules_valides_in_current(),
-            u.nb_modules_in_current(),
-            u.nb_cours_en_retard(),
-            ])
+    response = HttpResponse(csv_performances(groupes), mimetype='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s' % nom_fichier
+    return response
+
+@login_required
+def document(request, doc_id):
+    """
+    Téléchargement d'un document supplémentaire
+    """
+    try:
+        doc = AutresDocs.objects.select_related('groupe').get(id=doc_id)
+    except AutresDocs.DoesNotExist:
+        request.user.message_set.create(
+                message=_("This document does not exist."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    if request.user.groupe_id == doc.groupe_id:
+        autorise = doc.cours_id is None or \
+                UserCours(request.user, doc.cours).is_open()
+    else:
+        autorise = request.user.may_see_groupe(doc.groupe)
+    if not autorise:
+        request.user.message_set.create(
+                message=_("You are not allowed to download this document."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    try:
+        return sert_fichier(request, doc.fichier.path,
+                os.path.basename(doc.fichier.name))
+    except Http404:
+        request.user.message_set.create(
+                message=_("This document does not exist."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+
+def _zip(request, workdones, nom):
+    try:
+        flux = zip_workdone(workdones)
+    except ArchiveTropGrande:
+        request.user.message_set.create(
+            message=_("This archive is too large (more than 4 GB or 65535 files)."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    response = HttpResponse(flux, mimetype='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=%s' % nom
+    return response
+
+@login_required
+def workdone_cours(request, groupe_id, cours_id):
+    """
+    Archive zip des devoirs rendus d'un groupe pour un cours
+    """
+    try:
+        gc = CoursDuGroupe.objects.select_related('groupe', 'cours').get(
+                groupe=groupe_id, cours=cours_id)
+    except CoursDuGroupe.DoesNotExist:
+        request.user.message_set.create(
+                message=_("This group does not exist."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    if not request.user.may_see_groupe(gc.groupe) and \
+            not Prof.objects.filter(utilisateur=request.user,
+                    groupe=gc.groupe, cours=gc.cours).exists():
+        request.user.message_set.create(
+            message=_("You do not have admin rights on the requested group."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    workdones = WorkDone.objects.filter(utilisateur__groupe=gc.groupe,
+            work__cours=gc.cours).order_by('utilisateur__username', 'date')
+    return _zip(request, workdones, nom_archive(gc.groupe.id, gc.cours.slug))
+
+@login_required
+def workdone_user(request, user_id):
+    """
+    Archive zip des devoirs rendus d'un utilisateur
+    """
+    try:
+        utilisateur = Utilisateur.objects.select_related('groupe').get(
+                id=user_id)
+    except Utilisateur.DoesNotExist:
+        request.user.message_set.create(
+                message=_("This user does not exist."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    if utilisateur.groupe is None:
+        raise Http404
+    if not request.user.may_see_groupe(utilisateur.groupe):
+        request.user.message_set.create(
+            message=_("You do not have admin rights on the requested group."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    workdones = WorkDone.objects.filter(utilisateur=utilisateur).order_by('date')
+    return _zip(request, workdones,
+            nom_archive(utilisateur.groupe_id, utilisateur.username))
+
+def ical(request, groupe_id, user_id, signature):
+    """
+    Flux iCalendar du planning d'un groupe pour un utilisateur.
+    L'url est signée (voir Planning.ical_url) : les clients de calendrier
+    n'ont pas de session.
+    """
+    try:
+        utilisateur = Utilisateur.objects.get(id=user_id, is_active=True)
+        groupe = Groupe.objects.get(id=groupe_id)
+    except (Utilisateur.DoesNotExist, Groupe.DoesNotExist):
+        raise Http404
+    if not constant_time_compare(signature,
+            signature_ical(utilisateur, groupe.id)):
+        return HttpResponseForbidden()
+    if utilisateur.groupe_id != groupe.id and \
+            not utilisateur.may_see_groupe(groupe):
+        return HttpResponseForbidden()
+    activate(utilisateur.langue)
+    try:
+        weeks = int(request.GET.get('weeks', 26))
+    except ValueError:
+        weeks = 26
+    planning = Planning(request, groupe, weeks=weeks, user=utilisateur)
+    etag = planning.etag()
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(planning.ical(),
+                mimetype='text/calendar; charset=utf-8')
+    response['ETag'] = etag
     return response
 
 @login_required
@@ -312,20 +424,16 @@ def sendmail(request):
             attach = None
             if 'attach' in request.FILES:
                 attach = request.FILES['attach']
-            try:
-                mail = EmailMessage(subject=subject,
-                        body=message,
-                        from_email=from_email,
-                        to=email_list,
-                        headers={'Reply-To': reply_to})
-                if attach:
-                    mail.attach(attach.name, attach.read(), attach.content_type)
-                mail.send()
-                request.user.message_set.create(
-                        message=_("The message has been sent."))
-            except:
-                request.user.message_set.create(
-                        message=_("Error: unable to send message."))
+            mail = EmailMessage(subject=subject,
+                    body=message,
+                    from_email=from_email,
+                    to=email_list,
+                    headers={'Reply-To': reply_to})
+            if attach:
+                mail.attach(attach.name, attach.read(), attach.content_type)
+            envoie_plus_tard([mail])
+            request.user.message_set.create(
+                    message=_("The message has been queued for sending."))
             if utilisateur:
                 return HttpResponseRedirect(utilisateur.get_absolute_url())
             else:
@@ -403,73 +511,35 @@ def create_logins(request):
     """
     Création de logins à partir d'un fichier
     """
-    import os
     import time
-    import StringIO
-    import random
-    import sha
     if request.method == 'POST':
         if 'fsource' in request.POST:
             fsource = os.path.join(settings.MEDIA_ROOT,'logins',
-                    request.POST['fsource'])
+                    os.path.basename(request.POST['fsource']))
             g = Groupe.objects.get(id=request.POST['groupe'])
-            logins = []
+            fermeture = request.POST['fermeture']
+            if fermeture in ('', 'None'):
+                fermeture = None
             nom_logins = 'logins-g%s-%s.txt'% (g.id, 
                         time.strftime('%Y%m%d%H%M%S',time.localtime()))
             fich_logins = os.path.join(settings.MEDIA_ROOT,'logins',nom_logins)
             url_logins = os.path.join(settings.MEDIA_URL,'logins',nom_logins)
-            flogin = open(fich_logins,'w')
-            newline = ';'.join(('Last name','First name','Email','Password','\n'))
-            flogin.write(newline)
-            for line in open(fsource):
-                line = line.strip()
-                line = line.decode('iso-8859-1')
-                nom, prenom, email = line.split('\t')
-                nom = nom.strip().title()
-                prenom = prenom.strip().title()
-                username = email.split('@')[0][:30]
-#                login = unicodedata.normalize('NFKD',login).encode('ASCII',
-#                        'ignore').lower()
-#                login = login.replace(' ','')
-                password = sha.new(str(random.random())).hexdigest()[:8]
-                try:
-                    Utilisateur.objects.get(email=email)
-                    saved = False
-                    status = _('Exists already.')
-                except Utilisateur.DoesNotExist:
-                    u = Utilisateur(username=username, last_name=nom, 
-                                    first_name=prenom, 
-                                    email=email, 
-                                    fermeture=request.POST['fermeture'], 
-                                    langue=request.POST['langue'], groupe=g)
-                    u.set_password(password)
-                    u.save()
-                    saved = True
-                    status = _('Saved.')
-                if request.POST['envoi_mail']=='1' and saved:
-                    try:
-                        mailmsg = render_to_string('coaching/mail_login.txt', 
-                                {'login': u.email, 
-                                  'password': password,
-                                  'groupe': g.nom,
-                                  'coach': g.administrateur.get_full_name(),
-                                  'coach_mail': g.administrateur.email,})
-                        send_mail(subject='E-learning - %s' % g.client.nom,
-                                  message = mailmsg,
-                                  from_email='info@learngest.com',
-                                  recipient_list=[u.email],
-                                  )
-                        status = ' '.join((status,_('Mail sent.')))
-                    except IOError:
-                        status = ' '.join((status,_('Mail error.')))
-                if saved:
-                    newline = ';'.join((nom,prenom,email,password,'\n'))
-                    newline = newline.encode('iso-8859-1')
-                    flogin.write(newline)
-                logins.append({'email':email, 'password': password, 
-                                'nom':nom,'prenom':prenom,'status': status,
-                                })
-            flogin.close()
+            provision = Provision(g, request.POST['langue'], fermeture,
+                    envoi_mail=request.POST['envoi_mail']=='1',
+                    processes=getattr(settings, 'LOGINS_PROCESSES', 1))
+            source = open(fsource)
+            try:
+                logins = provision.cree(lit_source(source))
+            finally:
+                source.close()
+                # identifiants des tranches créées, même après une erreur
+                flogin = open(fich_logins,'w')
+                ecrit_logins(flogin, provision.logins)
+                flogin.close()
+            request.user.message_set.create(
+                    message=_("%(creees)d logins created in %(duree).1f s (%(debit).0f logins/s).") % {
+                        'creees': provision.creees, 'duree': provision.duree,
+                        'debit': provision.debit()})
             return render_to_response('coaching/create_logins3.html',
                                 {'title': _('Create logins'),
                                  'logins': logins,
@@ -487,40 +557,29 @@ def create_logins(request):
                     for g in Groupe.objects.order_by('nom')]
             if f.is_valid():
                 g = Groupe.objects.get(id=f.cleaned_data['groupe'])
-                start_now = False
                 logins = []
                 nom_source = "source-g%s-%s.txt" % (g.id, 
                         time.strftime('%Y%m%d%H%M%S',time.localtime()))
                 fich_source = os.path.join(settings.MEDIA_ROOT, 'logins', 
                         nom_source)
                 fsource = open(fich_source, 'w')
-                for line in StringIO.StringIO(request.FILES['source'].read()):
-                    if line.startswith('Nom\t'):
-                        start_now = True
-                        continue
-                    if start_now:
-                        line = line.decode('iso-8859-1').strip()
-                        if not line:
-                            continue
-                        try:
-                            nom, prenom, email = line.split('\t')
-                        except ValueError:
-                            request.user.message_set.create(
-                                    message=_("Invalid file content : %s") % line)
-                            fsource.close()
-                            os.unlink(fich_source)
-                            return render_to_response('coaching/create_logins.html',
-                                          {'title': _('Create logins'),
-                                           'form': f,
-                                          },
-                                          context_instance=RequestContext(request))
-                        nom = nom.strip().title()
-                        prenom = prenom.strip().title()
-                        email = email.strip().lower()
+                try:
+                    for nom, prenom, email in lit_source(
+                            request.FILES['source'], entete=True):
                         logins.append({'nom':nom,'prenom':prenom,'email':email})
-                        line = line.encode('iso-8859-1')
-                        fsource.write(line)
+                        line = '\t'.join((nom, prenom, email))
+                        fsource.write(line.encode('iso-8859-1'))
                         fsource.write('\n')
+                except LigneInvalide, e:
+                    request.user.message_set.create(
+                            message=_("Invalid file content : %s") % e)
+                    fsource.close()
+                    os.unlink(fich_source)
+                    return render_to_response('coaching/create_logins.html',
+                                  {'title': _('Create logins'),
+                                   'form': f,
+                                  },
+                                  context_instance=RequestContext(request))
                 fsource.close()
                 return render_to_response('coaching/create_logins2.html',
                                     {'title': _('Create logins'),
@@ -0,0 +1,70 @@
+# -*- encoding: utf-8 -*-
+"""
+Versions des fragments mis en cache du tableau de bord étudiant.
+
+Les fragments (calendrier, planning, documents, cours courant) sont
+mis en cache par le tag {% cache %} des templates, avec dans leur clé la
+version de l'utilisateur et celle de son groupe. Une version est une
+date placée dans le cache ; les signaux la remplacent (voir
+coaching.models) :
+- utilisateur : Resultat, GranuleValide, ModuleValide, WorkDone
+- groupe : CoursDuGroupe, Event, Work, AutresDocs
+Le cours courant dépend aussi de la date : il est calculé sur la
+progression au plus une fois par jour et par version, et sa clé entre
+dans celle du fragment.
+"""
+
+import time
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+# durée de vie des fragments (secondes)
+DUREE = getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 60*60)
+
+def cle_utilisateur(user_id):
+    return 'dashboard.utilisateur.%s' % user_id
+
+def cle_groupe(groupe_id):
+    return 'dashboard.groupe.%s' % groupe_id
+
+def versions(user):
+    """
+    Renvoie le dict des versions {'utilisateur', 'groupe', 'duree'}
+    en une lecture du cache
+    """
+    cles = {'utilisateur': cle_utilisateur(user.id),
+            'groupe': cle_groupe(user.groupe_id)}
+    lues = cache.get_many(cles.values())
+    resultat = {'duree': DUREE}
+    for nom, cle in cles.items():
+        if cle not in lues:
+            lues[cle] = time.time()
+            cache.set(cle, lues[cle])
+        resultat[nom] = lues[cle]
+    return resultat
+
+def cle_courant(user_id):
+    return 'dashboard.courant.%s' % user_id
+
+def cours_courant(user, versions):
+    """
+    Renvoie l'id du cours courant de l'utilisateur (None s'il n'a pas de
+    cours), recalculé quand une version ou le jour change
+    """
+    from learning.progress import user_progress
+    etat = (versions['utilisateur'], versions['groupe'], datetime.date.today())
+    entree = cache.get(cle_courant(user.id))
+    if entree and entree[0] == etat:
+        return entree[1]
+    cours = user_progress(user).cours_courant()
+    cours_id = cours and cours.id
+    cache.set(cle_courant(user.id), (etat, cours_id), DUREE)
+    return cours_id
+
+def invalide_utilisateur(user_id):
+    cache.set(cle_utilisateur(user_id), time.time())
+
+def invalide_groupe(groupe_id):
+    cache.set(cle_groupe(groupe_id), time.time())
@@ -1,12 +1,39 @@
 # -*- encoding: utf-8 -*-
 
+import time
 import datetime
 import calendar
 from operator import itemgetter
 
-from django.utils.translation import ugettext as _
+from django.core import urlresolvers
+from django.core.cache import cache
+from django.utils.crypto import salted_hmac
+from django.utils.translation import ugettext as _, get_language
 from coaching.models import CoursDuGroupe, Event, Work 
 
+# durée de vie d'un mois du calendrier dans le cache (secondes)
+DUREE = 60*60*24
+
+def cle_version(groupe_id):
+    return 'calendrier.%s' % groupe_id
+
+def version_calendrier(groupe_id):
+    """
+    Version du calendrier du groupe, fixée à la première lecture
+    """
+    version = cache.get(cle_version(groupe_id))
+    if version is None:
+        version = time.time()
+        cache.set(cle_version(groupe_id), version)
+    return version
+
+def invalide_calendrier(groupe_id):
+    """
+    Invalide tous les mois du calendrier (et le planning) du groupe,
+    après modification d'un Event, d'un CoursDuGroupe ou d'un Work
+    """
+    cache.set(cle_version(groupe_id), time.time())
+
 class Calendrier():
     """
     Calendrier pour un groupe d'étudiants.
@@ -32,56 +59,76 @@ class Calendrier():
                     message=_("Requested date is out of range."))
             self.date = datetime.datetime.now()
         self.cal = calendar.monthcalendar(self.date.year, self.date.month)
+        self._days = None
 
-    def days(self):
-        weeklist = []
-        for week in self.cal:
-            daylist = []
-            for day in week:
-                if day:
-                    daydict = {}
-                    daydict['num'] = day
-                    if datetime.date(self.date.year, self.date.month, day) \
-                            == datetime.date.today():
-                        daydict['today'] = True
-                    daylist.append(daydict)
-                else:
-                    daylist.append(day)
-            weeklist.append(daylist)
-        echeances_cours = CoursDuGroupe.objects.filter(
+    def cle(self):
+        """
+        Clé du mois dans le cache, pour le groupe, les langues et la
+        version du calendrier du groupe (voir invalide_calendrier)
+        """
+        return 'calendrier.%s.%s.%s.%s.%s' % (self.groupe.id,
+                version_calendrier(self.groupe.id),
+                self.user.langue, get_language(),
+                self.date.strftime('%Y%m'))
+
+    def evenements(self):
+        """
+        Renvoie le dict {jour: {'event', 'class', 'ref'}} des échéances
+        de cours, de devoirs et des évènements du mois, en trois requêtes
+        """
+        jours = {}
+        def ajoute(date, texte, classe):
+            jour = jours.setdefault(date.day, {
+                'event': [], 'class': classe, 'ref': date.strftime('%Y%m%d')})
+            jour['event'].append(texte)
+        echeances_cours = list(CoursDuGroupe.objects.filter(
                 groupe = self.groupe,
                 fin__year = self.date.year,
                 fin__month = self.date.month
-                )
-#        echeances_cours = self.groupe.cours.filter(
-#                fin__year = self.date.year,
-#                fin__month = self.date.month)
+                ).select_related('cours'))
+        fins = dict((e.cours_id, e.fin) for e in echeances_cours)
         for echeance in echeances_cours:
-            for week in weeklist:
-                for day in week:
-                    if day:
-                        if day['num'] == echeance.fin.day:
-                            titre = unicode(echeance.cours.titre(self.user.langue))
-                            day['event'] = _(u'Deadline for %s') % titre
-                            day['class'] = 'deadline'
-                            day['ref'] = echeance.fin.strftime('%Y%m%d')
-        other_events = Event.objects.filter(
+            titre = unicode(echeance.cours.titre(self.user.langue))
+            ajoute(echeance.fin, _(u'Deadline for %s') % titre, 'deadline')
+        if fins:
+            for devoir in Work.objects.filter(groupe=self.groupe,
+                    cours__in=fins.keys()):
+                ajoute(fins[devoir.cours_id],
+                    _(u'Deadline for assignment %s') % unicode(devoir.titre),
+                    'deadline')
+        for event in Event.objects.filter(
                 groupe = self.groupe,
                 date__year = self.date.year,
                 date__month = self.date.month
-                )
-        for event in other_events:
-            for week in weeklist:
-                for day in week:
-                    if day:
-                        if day['num'] == event.date.day:
-                            if 'event' in day:
-                                day['event'] = "%s - %s" % (day['event'], event.event)
-                            else:
-                                day['event'] = event.event
-                                day['class'] = 'event'
-                            day['ref'] = event.date.strftime('%Y%m%d')
-        return weeklist
+                ):
+            ajoute(event.date, event.event, 'event')
+        for jour in jours.values():
+            jour['event'] = u' - '.join(jour['event'])
+        return jours
+
+    def days(self):
+        """
+        Semaines du mois, chaque jour étant un dict (num, event...) ou 0.
+        Le mois est construit en un passage sur la grille à partir des
+        évènements regroupés par jour, puis conservé dans le cache ;
+        seul le jour courant est marqué à chaque appel.
+        """
+        if self._days is None:
+            cle = self.cle()
+            weeklist = cache.get(cle)
+            if weeklist is None:
+                jours = self.evenements()
+                weeklist = [[day and dict(jours.get(day, {}), num=day) or day
+                             for day in week] for week in self.cal]
+                cache.set(cle, weeklist, DUREE)
+            today = datetime.date.today()
+            if (today.year, today.month) == (self.date.year, self.date.month):
+                for week in weeklist:
+                    for day in week:
+                        if day and day['num'] == today.day:
+                            day['today'] = True
+            self._days = weeklist
+        return self._days
 
     def weekheader(self):
         """
@@ -117,38 +164,135 @@ class Calendrier():
 
 class Planning():
     """
-    Planning pour les prochaines semaines
+    Planning pour les prochaines semaines.
+    Les échéances des cours, les devoirs de ces cours et les évènements
+    sont lus en trois requêtes quelle que soit la durée (weeks).
     """
-    def __init__(self, request, groupe=None):
+    # horizon maximal (semaines)
+    MAX_WEEKS = 104
+
+    def __init__(self, request, groupe=None, weeks=None, user=None):
         self.date = datetime.date.today()
-        self.user = request.user
+        self.user = user or request.user
         if groupe:
             self.groupe = groupe
         else:
-            self.groupe = request.user.groupe
-        self.weeks = int(request.GET.get('weeks', 4))
+            self.groupe = self.user.groupe
+        if weeks is None:
+            try:
+                weeks = int(request.GET.get('weeks', 4))
+            except ValueError:
+                weeks = 4
+        self.weeks = min(max(weeks, 1), self.MAX_WEEKS)
         self.end = self.date + datetime.timedelta(self.weeks*7)
+        self._items = None
+
+    def items(self):
+        """
+        Liste des éléments du planning triés par date, dict :
+        - date
+        - event : libellé
+        - uid : identifiant stable de l'élément (flux iCalendar)
+        """
+        if self._items is None:
+            echeances_cours = list(CoursDuGroupe.objects.filter(
+                    groupe = self.groupe,
+                    fin__range = (self.date, self.end)
+                    ).select_related('cours'))
+            fins = dict((e.cours_id, e.fin) for e in echeances_cours)
+            _events = [{'date': e.fin,
+                'event': _(u'Deadline for %s') % unicode(
+                    e.cours.titre(self.user.langue)),
+                'uid': 'cours-%s-%s' % (e.groupe_id, e.cours_id),
+                } for e in echeances_cours]
+            if fins:
+                for d in Work.objects.filter(groupe=self.groupe,
+                        cours__in=fins.keys()):
+                    _events.append({
+                        'date': fins[d.cours_id],
+                        'event': _(u'Deadline for assignment %s') % unicode(
+                            d.titre),
+                        'uid': 'work-%s' % d.id,
+                        })
+            other_events = Event.objects.filter(
+                    groupe = self.groupe,
+                    date__range = (self.date, self.end)
+                    )
+            _events.extend([{'date': e.date, 'event': e.event,
+                'uid': 'event-%s' % e.id} for e in other_events])
+            self._items = sorted(_events, key=itemgetter('date'))
+        return self._items
 
     def events(self):
-        echeances_cours = CoursDuGroupe.objects.filter(
-                groupe = self.groupe,
-                fin__range = (self.date, self.end)
-                )
-        _events = [{'date': e.fin,
-            'event': _(u'Deadline for %s') % unicode(
-                e.cours.titre(self.user.langue))} for e in echeances_cours]
-        for e in echeances_cours:
-            devoirs = Work.objects.filter(groupe=self.groupe, cours=e.cours)
-            for d in devoirs:
-                _events.append({
-                    'date': e.fin,
-                    'event': _(u'Deadline for assignment %s') % unicode( d.titre)
-                    })
-        other_events = Event.objects.filter(
-                groupe = self.groupe,
-                date__range = (self.date, self.end)
-                )
-        _events.extend(
-                [{'date': e.date, 'event': e.event} for e in other_events])
-        _events = sorted(_events, key=itemgetter('date'))
-        return _events
+        return self.items()
+
+    def ical_url(self):
+        """
+        Url signée du flux iCalendar de ce planning pour l'utilisateur
+        """
+        return urlresolvers.reverse('coaching.views.ical', args=[
+            self.groupe.id, self.user.id,
+            signature_ical(self.user, self.groupe.id)])
+
+    def etag(self):
+        """
+        ETag du planning : version du calendrier du groupe, jour,
+        horizon et langue, sans lire les éléments
+        """
+        return '"%s-%s-%s-%s-%s-%s"' % (self.groupe.id,
+                version_calendrier(self.groupe.id),
+                self.date.strftime('%Y%m%d'), self.weeks, self.user.langue,
+                get_language())
+
+    def ical(self, nom=''):
+        """
+        Planning au format iCalendar (RFC 5545)
+        """
+        maintenant = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        lignes = ['BEGIN:VCALENDAR', 'VERSION:2.0',
+                  'PRODID:-//Learngest//Planning//EN',
+                  'CALSCALE:GREGORIAN',
+                  u'X-WR-CALNAME:%s' % _ical_texte(nom or self.groupe.nom)]
+        for item in self.items():
+            lignes.extend([
+                'BEGIN:VEVENT',
+                'UID:%s@learngest' % item['uid'],
+                'DTSTAMP:%s' % maintenant,
+                'DTSTART:%s' % item['date'].strftime('%Y%m%dT%H%M%S'),
+                u'SUMMARY:%s' % _ical_texte(item['event']),
+                'END:VEVENT'])
+        lignes.append('END:VCALENDAR')
+        return ''.join(['%s\r\n' % _ical_pliage(l.encode('utf-8'))
+                        for l in lignes])
+
+def _ical_texte(texte):
+    """
+    Echappement d'un texte iCalendar
+    """
+    for car, echappe in (('\\', '\\\\'), (';', '\\;'), (',', '\\,'),
+                         ('\n', '\\n')):
+        texte = texte.replace(car, echappe)
+    return texte
+
+def _ical_pliage(ligne):
+    """
+    Pliage d'une ligne iCalendar à 75 octets, sans couper un caractère utf-8
+    """
+    morceaux = []
+    while len(ligne) > 75:
+        coupure = 75
+        while coupure > 1 and (ord(ligne[coupure]) & 0xC0) == 0x80:
+            coupure -= 1
+        morceaux.append(ligne[:coupure])
+        ligne = ' ' + ligne[coupure:]
+    morceaux.append(ligne)
+    return '\r\n'.join(morceaux)
+
+def signature_ical(user, groupe_id):
+    """
+    Signature des urls du flux iCalendar de l'utilisateur pour un groupe,
+    par SECRET_KEY : elle ne change pas avec le mot de passe (ni son
+    hachage), les abonnements restent valides
+    """
+    return salted_hmac('dashboard.planning.ical',
+            '%s-%s' % (user.id, groupe_id)).hexdigest()[:20]
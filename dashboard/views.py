@@ -1,6 +1,7 @@
 # -*- encoding: utf-8 -*-
 
 import sys
+import datetime
 
 from django.template import RequestContext
 from django.shortcuts import render_to_response
@@ -8,11 +9,17 @@ from django.http import HttpResponseRedirect
 from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import login_required
 from django.core import urlresolvers
+from django.core.paginator import Paginator, InvalidPage
 
 from dashboard.planning import Calendrier, Planning
+from dashboard.fragments import versions, cours_courant
 from learning.controllers import UserCours
-from coaching.controllers import AdminGroupe, UserState
+from coaching.controllers import AdminGroupe, UserState, ApercuGroupes
 from coaching.models import Groupe, Prof, AutresDocs
+from coaching.droits import groupes_visibles
+
+# taille des pages du tableau de bord staff
+GROUPES_PAR_PAGE = 50
 
 @login_required
 def dashboard(request):
@@ -32,23 +39,27 @@ def dashboard(request):
 
 def dashboard_student(request):
     """
-    Tableau de bord étudiant
+    Tableau de bord étudiant.
+    Les fragments sont servis depuis le cache (voir dashboard.fragments) :
+    les objets passés au template ne font leurs requêtes que pour un
+    fragment à recalculer, et l'affichage n'écrit rien.
     """
     cal = Calendrier(request)
     planning = Planning(request)
     us = UserState(request.user)
-    course = us.cours_courant(recalcul=True)
-    #course = UserCours(request.user, request.user.current)
-    docs = AutresDocs.objects.filter(groupe=request.user.groupe,cours=None)
-
+    docs = AutresDocs.objects.filter(groupe=request.user.groupe_id, cours=None)
+    v = versions(request.user)
 
     return render_to_response('dashboard/etudiant.html',
                               {'title': _('dashboard'),
                                'here': 'dashboard',
                                'cal': cal,
                                'planning': planning,
-                               'course': course,
+                               'us': us,
                                'docs': docs,
+                               'versions': v,
+                               'courant': cours_courant(request.user, v),
+                               'today': datetime.date.today(),
                               },
                               context_instance=RequestContext(request))
 
@@ -88,7 +99,8 @@ def dashboard_assistant(request):
     Tableau de bord assistant
     """
     groupes = [AdminGroupe(request.user, groupe)
-            for groupe in Groupe.objects.filter(assistant=request.user)]
+            for groupe in Groupe.objects.filter(
+                id__in=groupes_visibles(request.user))]
     if len(groupes)==1:
         return HttpResponseRedirect(groupes[0].get_absolute_url)
     else:
@@ -101,16 +113,25 @@ def dashboard_assistant(request):
 
 def dashboard_staff(request):
     """
-    Tableau de bord staff
+    Tableau de bord staff : tous les groupes, triés et paginés
+    (voir ApercuGroupes)
     """
-    groupes = [AdminGroupe(request.user, groupe)
-                for groupe in Groupe.objects.exclude(client__nom='templates')]
+    apercu = ApercuGroupes(request.user,
+            Groupe.objects.exclude(client__nom='templates'))
+    tri = request.GET.get('o', 'nom')
+    groupes = apercu.lignes(tri)
     if len(groupes)==1:
-        return HttpResponseRedirect(groupes[0].get_absolute_url)
-    else:
-        return render_to_response('dashboard/admin.html',
-                                  {'title': _('dashboard'),
-                                   'here': 'dashboard',
-                                   'groupes': groupes,
-                                  },
-                                  context_instance=RequestContext(request))
+        return HttpResponseRedirect(groupes[0]['get_absolute_url'])
+    paginator = Paginator(groupes, GROUPES_PAR_PAGE)
+    try:
+        page = paginator.page(int(request.GET.get('page', 1)))
+    except (ValueError, InvalidPage):
+        page = paginator.page(paginator.num_pages)
+    return render_to_response('dashboard/staff.html',
+                              {'title': _('dashboard'),
+                               'here': 'dashboard',
+                               'groupes': page.object_list,
+                               'page': page,
+                               'tri': tri,
+                              },
+                              context_instance=RequestContext(request))
@@ -0,0 +1,95 @@
+# -*- encoding: utf-8 -*-
+"""
+Cache des contenus html des supports de cours.
+
+Les fichiers sont conservés en mémoire (par processus), indexés par
+chemin ; à chaque lecture un stat vérifie que le fichier n'a pas changé
+(date de modification et taille). La taille totale est bornée par
+settings.CONTENTS_CACHE_SIZE (octets), les fichiers les moins récemment
+lus sont oubliés en premier.
+"""
+
+import os
+import threading
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.template.defaulttags import include_is_allowed
+
+class CacheContenus(object):
+    """
+    Cache LRU de fichiers, borné en octets
+    """
+    def __init__(self, taille_max):
+        self.taille_max = taille_max
+        self.taille = 0
+        self._entrees = {}
+        self._compteur = 0
+        self._verrou = threading.Lock()
+
+    def lit(self, path):
+        """
+        Renvoie le contenu du fichier, depuis le cache s'il n'a pas changé.
+        Lève IOError ou OSError si le fichier est illisible.
+        """
+        st = os.stat(path)
+        signature = (st.st_mtime, st.st_size)
+        self._verrou.acquire()
+        try:
+            self._compteur += 1
+            entree = self._entrees.get(path)
+            if entree and entree[0] == signature:
+                entree[2] = self._compteur
+                return entree[1]
+        finally:
+            self._verrou.release()
+        f = open(path)
+        try:
+            contenu = f.read()
+        finally:
+            f.close()
+        if len(contenu) <= self.taille_max:
+            self._ajoute(path, signature, contenu)
+        return contenu
+
+    def _ajoute(self, path, signature, contenu):
+        self._verrou.acquire()
+        try:
+            self._oublie(path)
+            while self._entrees and \
+                    self.taille + len(contenu) > self.taille_max:
+                ancien = min(self._entrees.items(), key=lambda e: e[1][2])[0]
+                self._oublie(ancien)
+            self._entrees[path] = [signature, contenu, self._compteur]
+            self.taille += len(contenu)
+        finally:
+            self._verrou.release()
+
+    def _oublie(self, path):
+        entree = self._entrees.pop(path, None)
+        if entree:
+            self.taille -= len(entree[1])
+
+contenus = CacheContenus(
+        getattr(settings, 'CONTENTS_CACHE_SIZE', 32*1024*1024))
+
+_autorises = {}
+
+def is_allowed(path):
+    """
+    include_is_allowed, mémorisé par chemin
+    """
+    if path not in _autorises:
+        _autorises[path] = include_is_allowed(path)
+    return _autorises[path]
+
+_base = []
+
+def base_url():
+    """
+    Renvoie 'http://<domaine du site>', calculé une fois par processus
+    """
+    if not _base:
+        site_id = getattr(settings, 'SITE_ID', 1)
+        _base.append(''.join(('http://', Site.objects.get(id=site_id).domain)))
+    return _base[0]
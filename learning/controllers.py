@@ -6,10 +6,10 @@ from django.utils.translation import ugettext as _
 from django.core.cache import cache
 from django.conf import settings
 
-from coaching.models import CoursDuGroupe, Work, WorkDone, AutresDocs, Prof
+from coaching.models import WorkDone, AutresDocs, Prof
 from learning.models import Contenu
-from testing.models import Granule
 from testing.controllers import UserGranule
+from learning.progress import user_progress
 
 from listes import *
 
@@ -17,10 +17,11 @@ class UserModule(object):
     """
     Controller d'un module pour un utilisateur
     """
-    def __init__(self, user, module):
+    def __init__(self, user, module, progress=None):
         self.user = user
         self.module = module
-        self._date_validation = -1
+        self.progress = progress or user_progress(user)
+        self._tests = -1
 
     def titre(self):
         return self.module.titre(self.user.langue)
@@ -31,8 +32,10 @@ class UserModule(object):
                 langue=self.user.langue).order_by('type')
 
     def tests(self):
-        return [UserGranule(self.user,g) \
-                for g in Granule.objects.filter(module=self.module)]
+        if self._tests == -1:
+            self._tests = [UserGranule(self.user, g, self.progress)
+                    for g in self.progress.liste_granules(self.module)]
+        return self._tests
 
     def date_validation(self):
         """
@@ -40,27 +43,14 @@ class UserModule(object):
         False s'il n'est pas validé
         None si le module n'a pas de tests
         """
-        if self._date_validation == -1:
-            dates =  [t.date_validation() for t in self.tests()]
-            if not dates:
-                self._date_validation = None
-                return self._date_validation
-            if False in dates:
-                self._date_validation = False
-            else:
-                self._date_validation = max(dates)
-        return self._date_validation
+        return self.progress.date_module(self.module)
 
     def cours(self):
         """
         Renvoie l'objet Cours auquel appartient le module pour
         cet utilisateur
         """
-        liste_cours = self.user.groupe.cours.all()
-        for c in liste_cours:
-            if self.module in [mc.module for mc in c.modulecours_set.all()]:
-                return c
-        return None
+        return self.progress.cours_du_module(self.module)
 
     def is_open(self):
         """
@@ -68,27 +58,32 @@ class UserModule(object):
         """
         if self.user.statut == STAFF:
             return True
-        if not self.cours():
+        cours = self.cours()
+        if not cours:
             return False
-        if UserCours(self.user, self.cours()).is_open():
-            return True
-        return False
+        return self.progress.is_open(cours)
 
 
 class UserWork(object):
     """
     Controller d'un devoir pour un utilisateur
     """
-    def __init__(self, user, work):
+    def __init__(self, user, work, progress=None):
         self.user = user
         self.work = work
         self.titre = self.work.titre
-        try:
-            wd = WorkDone.objects.get(utilisateur=self.user, work=self.work)
+        if progress:
+            wd = progress.work_done(self.work)
+        else:
+            try:
+                wd = WorkDone.objects.get(utilisateur=self.user, work=self.work)
+            except WorkDone.DoesNotExist:
+                wd = None
+        if wd:
             self.date_remise = wd.date
             self.signature = wd.signature
             self.url = wd.fichier.url
-        except WorkDone.DoesNotExist:
+        else:
             self.date_remise = False
             self.signature = None
             self.url = None
@@ -98,34 +93,24 @@ class UserCours(object):
     """
     Controller d'un cours pour un utilisateur
     """
-    def __init__(self, user, cours):
+    def __init__(self, user, cours, progress=None):
         self._usermodules = -1
         self._usermodules_a_valider = -1
         self._assignments = -1
         self._autres_docs = -1
-        self._date_validation = -1
         self.user = user
         self.cours = cours
-        try:
-            cdg = CoursDuGroupe.objects.get(
-                    cours=self.cours,groupe=self.user.groupe)
-            self.debut = cdg.debut
-            self.fin = cdg.fin
-        except CoursDuGroupe.DoesNotExist:
-            self.debut = None
-            self.fin = None
-        self._liste_cours = []
+        self.progress = progress or user_progress(user)
+        self.debut = self.progress.debut(self.cours)
+        self.fin = self.progress.fin(self.cours)
 
     def _get_liste_cours(self):
-        if not self._liste_cours:
-            self._liste_cours = list(
-                    self.user.groupe.cours.order_by('coursdugroupe__rang'))
-        return self._liste_cours
+        return self.progress.liste_cours
 
     liste_cours = property(_get_liste_cours)
 
     def _get_rang(self):
-        return self.liste_cours.index(self.cours)
+        return self.progress.rang(self.cours)
 
     rang = property(_get_rang)
 
@@ -138,8 +123,8 @@ class UserCours(object):
 
     def modules(self):
         if self._usermodules == -1:
-            self._usermodules = [UserModule(self.user, m) 
-                    for m in self.cours.liste_modules()]
+            self._usermodules = [UserModule(self.user, m, self.progress)
+                    for m in self.progress.liste_modules(self.cours)]
         return self._usermodules
 
     def modules_a_valider(self):
@@ -156,10 +141,8 @@ class UserCours(object):
 
     def assignments(self):
         if self._assignments == -1:
-            self._assignments = [UserWork(self.user, w)
-                for w in Work.objects.filter(
-                cours=self.cours,
-                groupe=self.user.groupe)]
+            self._assignments = [UserWork(self.user, w, self.progress)
+                for w in self.progress.liste_works(self.cours)]
         return self._assignments
 
     def modules_valides(self):
@@ -171,18 +154,7 @@ class UserCours(object):
         False s'il n'est pas validé
         None s'il n'y a pas de tests dans le cours
         """
-        if self._date_validation == -1:
-            dates =  [m.date_validation() for m in self.modules()
-                                if m.date_validation() is not None]
-            dates.extend([w.date_remise for w in self.assignments()])
-            if dates:
-                if False in dates:
-                    self._date_validation = False
-                else:
-                    self._date_validation = max(dates)
-            else:
-                self._date_validation = None
-        return self._date_validation
+        return self.progress.date_cours(self.cours)
 
     valide = property(date_validation)
 
@@ -200,7 +172,8 @@ class UserCours(object):
         Renvoie l'objet UserCours précédent
         """
         if self.rang > 0:
-            return UserCours(self.user, self.liste_cours[self.rang-1])
+            return UserCours(self.user, self.liste_cours[self.rang-1],
+                    self.progress)
         else:
             return None
 
@@ -211,24 +184,7 @@ class UserCours(object):
         - ce cours est le premier pour le groupe
         - le cours précédent est validé et la date d'ouverture est passée
         """
-        if self.user.statut > ASSISTANT:
-            return True
-        if self.user.groupe.is_open:
-            return True
-        if self.rang == 0:
-            return True
-        if self.prec().valide:
-            if self.debut:
-                if datetime.datetime.now() >= self.debut:
-                    return True
-                else:
-                    return False
-            else:
-                return True
-        return False
-
-            
-        return self.prec().valide
+        return self.progress.is_open(self.cours)
 
     def state(self):
         """
@@ -1,9 +1,11 @@
 # -*- encoding: utf-8 -*-
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete, post_init
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
+from learning.titres import CatalogueTitres
 from listes import *
 
 class Module(models.Model):
@@ -26,11 +28,7 @@ class Module(models.Model):
         return self.slug
 
     def titre(self, langue):
-        try:
-            mt = self.moduletitre_set.get(langue=langue).titre
-        except ModuleTitre.DoesNotExist:
-            mt = self.slug
-        return mt
+        return titres_modules.titre(self, langue)
 
     def rang(self, cours):
         """
@@ -58,6 +56,10 @@ class ModuleTitre(models.Model):
     def __unicode__(self):
         return '%s : %s' % (self.module, self.titre)
 
+titres_modules = CatalogueTitres(ModuleTitre, 'module')
+post_save.connect(titres_modules.invalide, sender=ModuleTitre)
+post_delete.connect(titres_modules.invalide, sender=ModuleTitre)
+
 class Cours(models.Model):
     """
     Le modèle de base Cours.
@@ -78,11 +80,7 @@ class Cours(models.Model):
         return self.slug
 
     def titre(self, langue):
-        try:
-            ct = self.courstitre_set.get(langue=langue).titre
-        except CoursTitre.DoesNotExist:
-            ct = self.slug
-        return ct
+        return titres_cours.titre(self, langue)
 
     def liste_modules(self):
         """
@@ -106,6 +104,10 @@ class CoursTitre(models.Model):
     def __unicode__(self):
         return '%s : %s' % (self.cours, self.titre)
 
+titres_cours = CatalogueTitres(CoursTitre, 'cours')
+post_save.connect(titres_cours.invalide, sender=CoursTitre)
+post_delete.connect(titres_cours.invalide, sender=CoursTitre)
+
 class ModuleCours(models.Model):
     """
     Un module dans un cours avec un certain rang.
@@ -127,6 +129,32 @@ class ModuleCours(models.Model):
     def __unicode__(self):
         return u'%s - %s - %s' % (self.cours.slug, self.module.slug, self.rang)
 
+def invalide_index_modules(sender, instance, **kwargs):
+    """
+    Invalide les index module -> cours et marque, pour le recalcul de
+    leur progression, les groupes qui suivent l'ancien et le nouveau
+    cours (voir learning.progress)
+    """
+    from learning.progress import invalide_index_modules, \
+            marque_cours, memorise_origine
+    invalide_index_modules(instance)
+    cours = set([instance.cours_id,
+                 getattr(instance, '_cours_origine', None)])
+    cours.discard(None)
+    marque_cours(cours)
+    memorise_origine(instance)
+
+def memorise_origine(sender, instance, **kwargs):
+    """
+    Mémorise le cours d'origine, pour invalider aussi son index
+    """
+    from learning.progress import memorise_origine
+    memorise_origine(instance)
+
+post_init.connect(memorise_origine, sender=ModuleCours)
+post_save.connect(invalide_index_modules, sender=ModuleCours)
+post_delete.connect(invalide_index_modules, sender=ModuleCours)
+
 DICT_TYPE = {
         'htm': _("html content"),
         'swf': _("slideshow"),
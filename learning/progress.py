@@ -0,0 +1,610 @@
+# -*- encoding: utf-8 -*-
+"""
+Moteur de progression des utilisateurs.
+
+La structure des cours d'un groupe (cours, modules, granules, devoirs)
+et l'état d'un utilisateur (validations, devoirs rendus) sont chargés
+en un nombre fixe de requêtes, puis les controllers (UserCours,
+UserModule, UserGranule) interrogent les index en mémoire au lieu de
+lancer une requête par objet. L'index module -> cours de chaque groupe
+est conservé dans le cache entre les requêtes (voir index_modules).
+
+GroupeProgress charge l'état de tous les membres d'un groupe à la fois
+(une requête par table) et calcule les colonnes du tableau de groupe.
+
+maj_progression et maj_progression_groupe recopient cet état dans la
+table Progression (une ligne par utilisateur et par cours) et dans les
+compteurs de Utilisateur ; seules les lignes modifiées sont écrites.
+Elles sont appelées par les signaux (voir coaching.models) : validations,
+devoirs rendus, création d'un utilisateur ou changement de groupe, cours
+du groupe, modules des cours et granules des modules. Les valeurs qui
+dépendent de la date du jour (cours ouvert, retards) ne changent pas
+d'elles-mêmes : la commande recalcule_progression, lancée chaque nuit,
+les rafraîchit. Une modification des modules d'un cours ou des granules
+d'un module touche tous les groupes qui suivent le cours : ils sont
+seulement marqués, et recalculés par recalcule_progression --marques.
+"""
+
+import datetime
+import threading
+
+from django.core.cache import cache
+
+from coaching.models import CoursDuGroupe, GranuleValide, ModuleValide, \
+        Resultat, Work, WorkDone, Progression, Utilisateur
+from learning.models import ModuleCours
+from testing.models import Granule
+
+from listes import *
+
+def index_modules(groupe_id):
+    """
+    Renvoie le dict {module_id: cours_id} des modules du groupe.
+    Un module appartient au premier cours du groupe qui le contient.
+    L'index est construit en une requête et conservé dans le cache ;
+    voir invalide_index_modules.
+    """
+    cle = 'index_modules.%s' % groupe_id
+    index = cache.get(cle)
+    if index is None:
+        index = {}
+        # du dernier cours au premier : le premier cours l'emporte
+        for module_id, cours_id in ModuleCours.objects.filter(
+                cours__coursdugroupe__groupe=groupe_id).order_by(
+                '-cours__coursdugroupe__rang').values_list('module', 'cours'):
+            index[module_id] = cours_id
+        cache.set(cle, index)
+    return index
+
+def invalide_index_modules(instance):
+    """
+    Invalide les index des groupes touchés par la modification ou la
+    suppression d'un CoursDuGroupe ou d'un ModuleCours, avant et après
+    un changement de groupe ou de cours (valeur d'origine mémorisée par
+    le signal post_init, voir memorise_origine ; le dernier récepteur du
+    signal la remet à jour)
+    """
+    if isinstance(instance, CoursDuGroupe):
+        groupes = set([instance.groupe_id,
+                       getattr(instance, '_groupe_origine', None)])
+        groupes.discard(None)
+    else:
+        cours = set([instance.cours_id,
+                     getattr(instance, '_cours_origine', None)])
+        cours.discard(None)
+        groupes = set(CoursDuGroupe.objects.filter(
+                cours__in=cours).values_list('groupe', flat=True))
+    cache.delete_many(['index_modules.%s' % g for g in groupes])
+
+def memorise_origine(instance):
+    """
+    Mémorise le cours d'un ModuleCours, ou le groupe d'un CoursDuGroupe
+    ou d'un Work, tels que lus en base
+    """
+    if isinstance(instance, ModuleCours):
+        instance._cours_origine = instance.cours_id
+    else:
+        instance._groupe_origine = instance.groupe_id
+
+class GroupeStructure(object):
+    """
+    Structure des cours d'un groupe, chargée en bloc :
+    cours ordonnés, modules des cours, granules des modules, devoirs
+    """
+    def __init__(self, groupe):
+        self.groupe = groupe
+        cdgs = list(CoursDuGroupe.objects.filter(
+                groupe=groupe).select_related('cours').order_by('rang'))
+        self.liste_cours = [cdg.cours for cdg in cdgs]
+        self.cdg = dict((cdg.cours_id, cdg) for cdg in cdgs)
+        self.rangs = dict((c.id, i) for i, c in enumerate(self.liste_cours))
+        self.modules = dict((c.id, []) for c in self.liste_cours)
+        if self.liste_cours:
+            for mc in ModuleCours.objects.filter(
+                    cours__in=self.rangs.keys()).select_related('module'):
+                self.modules[mc.cours_id].append(mc.module)
+        # module -> cours par l'index du groupe (cache, voir index_modules)
+        cours = dict((c.id, c) for c in self.liste_cours)
+        self.cours_modules = {}
+        if cours:
+            for module_id, cours_id in index_modules(groupe.id).items():
+                if cours_id in cours:
+                    self.cours_modules[module_id] = cours[cours_id]
+        self.granules = dict((mid, []) for mid in self.cours_modules)
+        if self.cours_modules:
+            for g in Granule.objects.filter(
+                    module__in=self.cours_modules.keys()):
+                self.granules[g.module_id].append(g)
+        self.works = dict((c.id, []) for c in self.liste_cours)
+        for w in Work.objects.filter(groupe=groupe):
+            self.works.setdefault(w.cours_id, []).append(w)
+
+    def debut(self, cours):
+        """
+        Date d'ouverture du cours pour le groupe, None si aucune
+        """
+        cdg = self.cdg.get(cours.id)
+        return cdg and cdg.debut
+
+    def fin(self, cours):
+        """
+        Date limite de validation du cours pour le groupe, None si aucune
+        """
+        cdg = self.cdg.get(cours.id)
+        return cdg and cdg.fin
+
+    def rang(self, cours):
+        """
+        Rang du cours dans la liste des cours du groupe
+        """
+        return self.rangs[cours.id]
+
+    def cours_du_module(self, module):
+        """
+        Cours auquel appartient le module pour ce groupe,
+        None si le module n'est dans aucun de ses cours
+        """
+        return self.cours_modules.get(module.id)
+
+    def liste_modules(self, cours):
+        """
+        Modules du cours, chargés à la demande si le cours
+        n'appartient pas au groupe
+        """
+        if cours.id not in self.modules:
+            self.modules[cours.id] = cours.liste_modules()
+        return self.modules[cours.id]
+
+    def liste_granules(self, module):
+        """
+        Granules du module, chargées à la demande si le module
+        n'appartient pas aux cours du groupe
+        """
+        if module.id not in self.granules:
+            self.granules[module.id] = list(
+                    Granule.objects.filter(module=module))
+        return self.granules[module.id]
+
+    def liste_works(self, cours):
+        return self.works.get(cours.id, [])
+
+    def nb_works(self):
+        return sum([len(l) for l in self.works.values()])
+
+class UserProgress(object):
+    """
+    Etat de progression d'un utilisateur.
+
+    structure : GroupeStructure du groupe de l'utilisateur,
+    chargée si elle n'est pas fournie.
+    etat : dict des validations de l'utilisateur
+    (granules_valides, modules_enregistres, works_done),
+    chargé si il n'est pas fourni.
+    """
+    def __init__(self, user, structure=None, etat=None):
+        self.user = user
+        self.structure = structure or GroupeStructure(user.groupe)
+        if etat is None:
+            etat = {
+                'granules_valides': dict(GranuleValide.objects.filter(
+                    utilisateur=user).values_list('granule', 'date')),
+                'modules_enregistres': dict(ModuleValide.objects.filter(
+                    utilisateur=user).values_list('module', 'date')),
+                'works_done': dict((wd.work_id, wd) for wd in
+                    WorkDone.objects.filter(utilisateur=user)),
+                }
+        self.granules_valides = etat['granules_valides']
+        self.modules_enregistres = etat['modules_enregistres']
+        self.works_done = etat['works_done']
+        self._resultats = None
+        self._ouverts = None
+        self._dates_modules = {}
+        self._dates_cours = {}
+
+    def __getattr__(self, name):
+        # liste_cours, debut, fin, rang, liste_modules... : voir GroupeStructure
+        if name == 'structure':
+            raise AttributeError(name)
+        return getattr(self.structure, name)
+
+    def work_done(self, work):
+        """
+        WorkDone de l'utilisateur pour ce devoir, None s'il n'est pas rendu
+        """
+        return self.works_done.get(work.id)
+
+    def resultats(self, granule):
+        """
+        Liste des (score, date) de l'utilisateur pour la granule,
+        meilleur score en premier.
+        Tous les résultats de l'utilisateur sont chargés au premier appel.
+        """
+        if self._resultats is None:
+            self._resultats = {}
+            for gid, score, date in Resultat.objects.filter(
+                    utilisateur=self.user).order_by('-score').values_list(
+                    'granule', 'score', 'date'):
+                self._resultats.setdefault(gid, []).append((score, date))
+        return self._resultats.get(granule.id, [])
+
+    def date_granule(self, granule):
+        """
+        Renvoie la date de validation de la granule
+        False si elle n'est pas validée
+        """
+        return self.granules_valides.get(granule.id, False)
+
+    def date_module(self, module):
+        """
+        Renvoie la date de validation du module
+        False s'il n'est pas validé
+        None si le module n'a pas de tests
+        """
+        if module.id not in self._dates_modules:
+            dates = [self.date_granule(g) for g in self.liste_granules(module)]
+            if not dates:
+                date = None
+            elif False in dates:
+                date = False
+            else:
+                date = max(dates)
+            self._dates_modules[module.id] = date
+        return self._dates_modules[module.id]
+
+    def date_cours(self, cours):
+        """
+        Renvoie la date de validation du cours
+        False s'il n'est pas validé
+        None s'il n'y a pas de tests dans le cours
+        """
+        if cours.id not in self._dates_cours:
+            dates = [self.date_module(m) for m in self.liste_modules(cours)]
+            dates = [d for d in dates if d is not None]
+            for w in self.liste_works(cours):
+                wd = self.work_done(w)
+                dates.append(wd and wd.date or False)
+            if not dates:
+                date = None
+            elif False in dates:
+                date = False
+            else:
+                date = max(dates)
+            self._dates_cours[cours.id] = date
+        return self._dates_cours[cours.id]
+
+    valide = date_cours
+
+    def modules_valides(self, cours):
+        """
+        Liste des modules validés du cours
+        """
+        return [m for m in self.liste_modules(cours) if self.date_module(m)]
+
+    def modules_a_valider(self, cours):
+        """
+        Liste des modules du cours qui ont des tests
+        """
+        return [m for m in self.liste_modules(cours)
+                if self.liste_granules(m)]
+
+    def valide_en_retard(self, cours):
+        valide = self.date_cours(cours)
+        fin = self.fin(cours)
+        if valide and fin:
+            return valide > fin
+        return False
+
+    def en_retard(self, cours):
+        fin = self.fin(cours)
+        if fin and not self.date_cours(cours):
+            return fin < datetime.datetime.now()
+        return False
+
+    def cours_ouverts(self):
+        """
+        Renvoie le dict {cours_id: True si le cours est ouvert} de tous
+        les cours de l'utilisateur, calculé en un seul passage sur la
+        liste ordonnée des cours, puis conservé.
+        Un cours est ouvert si :
+        - tous les cours sont ouverts pour le groupe
+        - ce cours est le premier pour le groupe
+        - le cours précédent est validé et la date d'ouverture est passée
+        """
+        if self._ouverts is None:
+            now = datetime.datetime.now()
+            tous = self.user.statut > ASSISTANT or self.groupe.is_open
+            self._ouverts = {}
+            prec_valide = True
+            for rang, cours in enumerate(self.liste_cours):
+                if tous or rang == 0:
+                    ouvert = True
+                elif prec_valide:
+                    debut = self.debut(cours)
+                    ouvert = not debut or now >= debut
+                else:
+                    ouvert = False
+                self._ouverts[cours.id] = ouvert
+                prec_valide = self.date_cours(cours)
+        return self._ouverts
+
+    def is_open(self, cours):
+        """
+        Renvoie True si le cours est ouvert, voir cours_ouverts
+        """
+        if self.user.statut > ASSISTANT or self.groupe.is_open:
+            return True
+        return self.cours_ouverts().get(cours.id, False)
+
+    def cours_courant(self):
+        """
+        Cours "courant", c-a-d celui qui suit le dernier validé
+        s'il est ouvert, le dernier validé sinon.
+        None si l'utilisateur n'a pas de cours.
+        """
+        if not self.liste_cours:
+            return None
+        now = datetime.datetime.now()
+        for rang, cours in enumerate(self.liste_cours):
+            if self.date_cours(cours) is False:
+                debut = self.debut(cours)
+                if debut and debut > now:
+                    return self.liste_cours[max(rang-1, 0)]
+                return cours
+        return self.liste_cours[-1]
+
+    def compteurs(self):
+        """
+        Renvoie le dict des compteurs de performance, avec les noms
+        des champs correspondants de Utilisateur
+        """
+        courant = self.cours_courant()
+        if courant:
+            nb_modules = len(self.modules_a_valider(courant))
+            nb_valides = len(self.modules_valides(courant))
+        else:
+            nb_modules = nb_valides = 0
+        return {
+            'current': courant,
+            'nb_cours_valides': len([1 for c in self.liste_cours
+                                    if self.date_cours(c)]),
+            'nb_travaux_rendus': len(self.works_done),
+            'nb_actuel': len([1 for c in self.liste_cours
+                                    if self.en_retard(c)]),
+            'nb_retards': len([1 for c in self.liste_cours
+                                    if self.valide_en_retard(c)]),
+            'nb_modules': nb_modules,
+            'nb_valides': nb_valides,
+            }
+
+class GroupeProgress(object):
+    """
+    Matrice de progression d'un groupe.
+
+    Les validations de tous les membres du groupe sont chargées en une
+    requête par table, et chaque utilisateur reçoit son UserProgress
+    (voir user_progress). Les colonnes du tableau de groupe sont
+    calculées en mémoire :
+    - dates[user_id][cours_id] : date de validation du cours
+    - colonnes[user_id] : compteurs, voir UserProgress.compteurs
+
+    La structure peut être fournie pour traiter un grand groupe
+    par tranches d'utilisateurs.
+    """
+    # au-delà, les validations sont filtrées sur le groupe et non sur les ids
+    MAX_IDS = 500
+
+    def __init__(self, groupe, users, structure=None):
+        self.groupe = groupe
+        self.structure = structure or GroupeStructure(groupe)
+        self.users = list(users)
+        etats = dict((u.id, {'granules_valides': {},
+                             'modules_enregistres': {},
+                             'works_done': {}}) for u in self.users)
+        if len(etats) > self.MAX_IDS:
+            lookup = {'utilisateur__groupe': groupe}
+        else:
+            lookup = {'utilisateur__in': etats.keys() or [0]}
+        for uid, gid, date in GranuleValide.objects.filter(
+                **lookup).values_list('utilisateur', 'granule', 'date'):
+            if uid in etats:
+                etats[uid]['granules_valides'][gid] = date
+        for uid, mid, date in ModuleValide.objects.filter(
+                **lookup).values_list('utilisateur', 'module', 'date'):
+            if uid in etats:
+                etats[uid]['modules_enregistres'][mid] = date
+        for wd in WorkDone.objects.filter(**lookup):
+            if wd.utilisateur_id in etats:
+                etats[wd.utilisateur_id]['works_done'][wd.work_id] = wd
+        self.dates = {}
+        self.colonnes = {}
+        for u in self.users:
+            u.groupe = groupe
+            u._progress = UserProgress(u, self.structure, etats[u.id])
+            self.dates[u.id] = dict((c.id, u._progress.date_cours(c))
+                    for c in self.structure.liste_cours)
+            self.colonnes[u.id] = u._progress.compteurs()
+
+    def applique(self, user):
+        """
+        Recopie les compteurs calculés dans les champs de l'utilisateur,
+        sans sauvegarde
+        """
+        for key, value in self.colonnes[user.id].items():
+            setattr(user, key, value)
+
+def user_progress(user):
+    """
+    Renvoie le UserProgress de l'utilisateur, conservé sur l'instance
+    user (donc pour la durée de la requête)
+    """
+    if getattr(user, '_progress', None) is None:
+        user._progress = UserProgress(user)
+    return user._progress
+
+def reset_progress(user):
+    """
+    Oublie le UserProgress de l'utilisateur, après une écriture
+    de validation ou de devoir
+    """
+    user._progress = None
+
+COMPTEURS = ('current', 'nb_cours_valides', 'nb_travaux_rendus',
+             'nb_actuel', 'nb_retards', 'nb_modules', 'nb_valides')
+
+def rafraichit_progression(user):
+    """
+    Oublie le UserProgress de l'utilisateur et relit ses compteurs, écrits
+    en base par les signaux : un user.save() ultérieur ne remet pas les
+    anciennes valeurs
+    """
+    reset_progress(user)
+    valeurs = Utilisateur.objects.filter(id=user.id).values(
+            *[k == 'current' and 'current_id' or k for k in COMPTEURS])
+    for key, value in valeurs and valeurs[0].items() or ():
+        if key == 'current_id' and value != user.current_id and \
+                hasattr(user, '_current_cache'):
+            # le cours chargé n'est plus le bon
+            del user._current_cache
+        setattr(user, key, value)
+
+def lignes_progression(progress):
+    """
+    Renvoie le dict {cours_id: valeurs des champs de Progression}
+    de l'utilisateur
+    """
+    courant = progress.cours_courant()
+    lignes = {}
+    for rang, cours in enumerate(progress.liste_cours):
+        works = progress.liste_works(cours)
+        lignes[cours.id] = {
+            'rang': rang,
+            'fin': progress.fin(cours),
+            'nb_modules': len(progress.modules_a_valider(cours)),
+            'nb_valides': len(progress.modules_valides(cours)),
+            'nb_travaux': len(works),
+            'nb_rendus': len([1 for w in works if progress.work_done(w)]),
+            'valide': progress.date_cours(cours) or None,
+            'courant': cours == courant,
+            }
+    return lignes
+
+def _maj(user, progress, existantes, creer=True):
+    """
+    Ecrit les lignes de Progression et les compteurs de l'utilisateur
+    qui diffèrent de l'état calculé.
+    existantes : lignes Progression actuelles de l'utilisateur
+    """
+    lignes = lignes_progression(progress)
+    for p in existantes:
+        valeurs = lignes.pop(p.cours_id, None)
+        if valeurs is None or p.groupe_id != user.groupe_id:
+            p.delete()
+        elif [1 for k, v in valeurs.items() if getattr(p, k) != v]:
+            Progression.objects.filter(id=p.id).update(**valeurs)
+    if creer and user.groupe_id:
+        for cours_id, valeurs in lignes.items():
+            Progression.objects.create(utilisateur_id=user.id,
+                    groupe_id=user.groupe_id, cours_id=cours_id, **valeurs)
+    compteurs = progress.compteurs()
+    # current est comparé sur l'id, sans charger le cours de user
+    calcules = dict(compteurs, current=compteurs['current'] and
+            compteurs['current'].id)
+    if [1 for k, v in calcules.items()
+            if getattr(user, k == 'current' and 'current_id' or k) != v]:
+        Utilisateur.objects.filter(id=user.id).update(**compteurs)
+        for key, value in compteurs.items():
+            setattr(user, key, value)
+
+# utilisateurs dont la mise à jour est différée (voir differe_progression)
+_differes = threading.local()
+
+def differe_progression():
+    """
+    Diffère les mises à jour de progression du thread jusqu'à
+    applique_progression() : une écriture en plusieurs étapes (notation
+    d'un test) ne recalcule qu'une fois, hors de sa transaction.
+    """
+    _differes.users = {}
+
+def applique_progression():
+    """
+    Fait les mises à jour différées depuis differe_progression()
+    """
+    users = getattr(_differes, 'users', None) or {}
+    _differes.users = None
+    for user, creer in users.values():
+        maj_progression(user, creer)
+
+def maj_progression(user, creer=True):
+    """
+    Met à jour la progression stockée de l'utilisateur, après une
+    validation ou un devoir rendu
+    creer : False pour ne faire que modifier ou supprimer des lignes
+    """
+    differes = getattr(_differes, 'users', None)
+    if differes is not None:
+        creer = creer or differes.get(user.id, (None, False))[1]
+        differes[user.id] = (user, creer)
+        return
+    reset_progress(user)
+    _maj(user, user_progress(user),
+            Progression.objects.filter(utilisateur=user), creer)
+
+def maj_progression_groupe(groupe, users=None, creer=True):
+    """
+    Met à jour la progression stockée des membres du groupe (tous si
+    users est None), après une modification des cours du groupe.
+    Les lignes existantes sont lues en une requête.
+    """
+    if users is None:
+        users = Utilisateur.objects.filter(groupe=groupe)
+    matrice = GroupeProgress(groupe, users)
+    existantes = {}
+    lookup = {'utilisateur__in': [u.id for u in matrice.users] or [0]}
+    if len(matrice.users) > GroupeProgress.MAX_IDS:
+        lookup = {'groupe': groupe}
+    for p in Progression.objects.filter(**lookup):
+        existantes.setdefault(p.utilisateur_id, []).append(p)
+    for u in matrice.users:
+        _maj(u, u._progress, existantes.get(u.id, []), creer)
+    return matrice
+
+# groupes dont la progression est à recalculer (voir marque_cours)
+CLE_MARQUES = 'progression.marques'
+DUREE_MARQUES = 60*60*24*7
+
+def marque_cours(cours_ids):
+    """
+    Marque les groupes qui suivent ces cours, après une modification de
+    leurs modules : leur progression est recalculée hors de la requête
+    d'administration par recalcule_progression --marques (cron). Une
+    marque perdue par le cache est rattrapée par le recalcul de la nuit.
+    """
+    groupes = set(CoursDuGroupe.objects.filter(
+            cours__in=cours_ids).values_list('groupe', flat=True))
+    if groupes:
+        cache.set(CLE_MARQUES, (cache.get(CLE_MARQUES) or set()) | groupes,
+                  DUREE_MARQUES)
+
+def marque_modules(module_ids):
+    """
+    Idem, après une modification des granules de ces modules
+    """
+    marque_cours(set(ModuleCours.objects.filter(
+            module__in=module_ids).values_list('cours', flat=True)))
+
+def groupes_marques():
+    """
+    Ids des groupes marqués par marque_cours
+    """
+    return cache.get(CLE_MARQUES) or set()
+
+def demarque(groupe_ids):
+    """
+    Retire les groupes recalculés des marques
+    """
+    restants = groupes_marques() - set(groupe_ids)
+    if restants:
+        cache.set(CLE_MARQUES, restants, DUREE_MARQUES)
+    else:
+        cache.delete(CLE_MARQUES)
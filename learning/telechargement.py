@@ -0,0 +1,152 @@
+# -*- encoding: utf-8 -*-
+"""
+Envoi de fichiers après contrôle d'accès.
+
+Les vues vérifient les droits de l'utilisateur puis appellent
+sert_fichier(). Si settings.SENDFILE_HEADER est défini, l'envoi est
+délégué au serveur web :
+- 'X-Sendfile' (Apache mod_xsendfile, lighttpd) : chemin du fichier
+- 'X-Accel-Redirect' (nginx) : url interne déduite de
+  settings.SENDFILE_ALIASES, tuple de (répertoire, url interne)
+Sinon le fichier est projeté en mémoire (mmap) et envoyé par blocs.
+Dans les deux cas ETag, Last-Modified et les requêtes Range (un seul
+intervalle) sont gérés.
+"""
+
+import os
+import re
+import mmap
+import stat
+import mimetypes
+import urllib
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+# taille des blocs envoyés (octets)
+BLOC = 64*1024
+
+SENDFILE_HEADER = getattr(settings, 'SENDFILE_HEADER', None)
+SENDFILE_ALIASES = getattr(settings, 'SENDFILE_ALIASES', ())
+
+_range = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def etag(st):
+    """
+    ETag d'un fichier, d'après son stat (date de modification et taille)
+    """
+    return '"%x-%x"' % (int(st.st_mtime), st.st_size)
+
+def intervalle(entete, taille):
+    """
+    Renvoie (debut, fin) inclus demandés par l'entête Range,
+    None si l'entête est absent, multiple ou illisible (fichier complet),
+    () si l'intervalle est hors du fichier (réponse 416)
+    """
+    m = _range.match(entete.replace(' ', ''))
+    if not m or m.groups() == ('', ''):
+        return None
+    debut, fin = m.groups()
+    if not debut:
+        # suffixe : les <fin> derniers octets
+        debut, fin = max(taille - int(fin), 0), taille - 1
+    else:
+        debut = int(debut)
+        if fin:
+            fin = min(int(fin), taille - 1)
+        else:
+            fin = taille - 1
+    if debut >= taille or debut > fin:
+        return ()
+    return debut, fin
+
+def _blocs(path, debut, fin):
+    """
+    Générateur des blocs [debut, fin] du fichier, lu par mmap
+    """
+    f = open(path, 'rb')
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = debut
+            while pos <= fin:
+                suivant = min(pos + BLOC, fin + 1)
+                yield m[pos:suivant]
+                pos = suivant
+        finally:
+            m.close()
+    finally:
+        f.close()
+
+def _alias(path):
+    """
+    Url interne nginx du fichier, None s'il n'est dans aucun alias
+    """
+    for repertoire, url in SENDFILE_ALIASES:
+        repertoire = os.path.join(repertoire, '')
+        if path.startswith(repertoire):
+            return url.rstrip('/') + '/' + urllib.quote(path[len(repertoire):])
+    return None
+
+def sert_fichier(request, path, nom=None, mimetype=None):
+    """
+    Renvoie la réponse HTTP envoyant le fichier path.
+    nom : nom proposé au navigateur (Content-Disposition: attachment),
+          affiché dans le navigateur si None
+    Lève Http404 si le fichier n'existe pas.
+    """
+    path = os.path.abspath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        raise Http404
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404
+    taille = st.st_size
+    tag = etag(st)
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if request.META.get('HTTP_IF_NONE_MATCH') == tag or (
+            'HTTP_IF_NONE_MATCH' not in request.META and
+            'HTTP_IF_MODIFIED_SINCE' in request.META and
+            not was_modified_since(request.META['HTTP_IF_MODIFIED_SINCE'],
+                                   st.st_mtime, taille)):
+        response = HttpResponseNotModified()
+        response['ETag'] = tag
+        return response
+    url = SENDFILE_HEADER == 'X-Accel-Redirect' and _alias(path)
+    if SENDFILE_HEADER and (url or SENDFILE_HEADER != 'X-Accel-Redirect'):
+        # le serveur web envoie le fichier et gère lui-même Range
+        response = HttpResponse('', mimetype=mimetype)
+        response[SENDFILE_HEADER] = url or path
+    else:
+        plage = None
+        if 'HTTP_RANGE' in request.META and \
+                request.META.get('HTTP_IF_RANGE', tag) == tag:
+            plage = intervalle(request.META['HTTP_RANGE'], taille)
+        if plage == ():
+            response = HttpResponse('', status=416)
+            response['Content-Range'] = 'bytes */%d' % taille
+            return response
+        if plage:
+            debut, fin = plage
+            response = HttpResponse(_blocs(path, debut, fin),
+                                    mimetype=mimetype, status=206)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (
+                    debut, fin, taille)
+        else:
+            debut, fin = 0, taille - 1
+            response = HttpResponse(taille and _blocs(path, debut, fin) or '',
+                                    mimetype=mimetype)
+        response['Content-Length'] = str(fin - debut + 1)
+        response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = tag
+    response['Last-Modified'] = http_date(st.st_mtime)
+    if nom:
+        if isinstance(nom, unicode):
+            nom = nom.encode('utf-8')
+        response['Content-Disposition'] = 'attachment; filename="%s"' % \
+                nom.replace('"', '')
+    return response
@@ -0,0 +1,68 @@
+# -*- encoding: utf-8 -*-
+"""
+Catalogue des titres traduits (CoursTitre, ModuleTitre, GranuleTitre).
+
+Les titres d'une langue sont chargés en une requête au premier appel,
+puis servis depuis la mémoire du processus. Les signaux post_save et
+post_delete des modèles de titres invalident le catalogue ; les autres
+processus sont prévenus via une date de modification placée dans le
+cache Django, relue au plus toutes les VERIFICATION secondes.
+"""
+
+import time
+
+from django.core.cache import cache
+
+# délai (secondes) entre deux vérifications de la date de modification
+VERIFICATION = 30
+
+class CatalogueTitres(object):
+    """
+    Titres d'un modèle de titres, par langue puis par id de l'objet titré.
+    model : modèle de titres (CoursTitre...)
+    champ : nom de la clé étrangère vers l'objet titré ('cours'...)
+    """
+    def __init__(self, model, champ):
+        self.model = model
+        self.champ = champ
+        self.cle = 'titres.%s' % model._meta.db_table
+        self._titres = {}
+        # date de chargement des titres, par langue
+        self._charge_le = {}
+        self._verifie_le = 0
+
+    def _verifie(self):
+        now = time.time()
+        if now - self._verifie_le > VERIFICATION:
+            self._verifie_le = now
+            modifie_le = cache.get(self.cle)
+            if modifie_le:
+                for langue, charge_le in self._charge_le.items():
+                    if modifie_le > charge_le:
+                        self._titres.pop(langue, None)
+                        del self._charge_le[langue]
+
+    def titres(self, langue):
+        """
+        Dict {id de l'objet titré: titre} pour la langue
+        """
+        self._verifie()
+        if langue not in self._titres:
+            self._charge_le[langue] = time.time()
+            self._titres[langue] = dict(self.model.objects.filter(
+                    langue=langue).values_list(self.champ, 'titre'))
+        return self._titres[langue]
+
+    def titre(self, obj, langue):
+        """
+        Titre de obj dans la langue, son slug si le titre n'existe pas
+        """
+        return self.titres(langue).get(obj.id, obj.slug)
+
+    def invalide(self, sender=None, **kwargs):
+        """
+        Récepteur des signaux post_save et post_delete du modèle de titres
+        """
+        self._titres = {}
+        self._charge_le = {}
+        cache.set(self.cle, time.time())
@@ -6,19 +6,21 @@ import os.path
 import datetime
 
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, Http404
 from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.template import RequestContext
 from django.conf import settings
-from django.contrib.sites.models import Site
-from django.template.defaulttags import include_is_allowed
 
 from learning.models import Cours, Module, Contenu, ModuleTitre
 from coaching.models import Work, WorkDone, Groupe
 from testing.models import Granule, Question
 from coaching.forms import WorkForm
 from learning.controllers import UserCours, UserModule
+from learning.contenus import contenus, is_allowed, base_url
+from learning.progress import rafraichit_progression
+from learning.telechargement import sert_fichier
+from coaching.archives import FichierSigne
 
 LOGIN_REDIRECT_URL = getattr(settings, 'LOGIN_REDIRECT_URL', '/')
 
@@ -50,9 +52,7 @@ def support(request, contenu_id=None):
         except Contenu.DoesNotExist:
             request.user.message_set.create(
                 message=_("Sorry, this content is not available in your prefered language."))
-    site_id = getattr(settings, 'SITE_ID', 1)
-    site = Site.objects.get(id=site_id)
-    base = ''.join(('http://', site.domain))
+    base = base_url()
     contents_prefix = getattr(settings, 'CONTENTS_PREFIX', 'contents')
     curmod = sys.modules['learning.views']
     fonction = 'render_%s' % contenu.type
@@ -69,13 +69,13 @@ def render_htm(request, c, base, contents_prefix):
                             c.ressource)
     support_path = os.path.join(settings.PROJECT_PATH, suffixe)
     base = os.path.join(base, suffixe)
-    if not include_is_allowed(support_path):
+    if not is_allowed(support_path):
         request.user.message_set.create(
                 message=_("You are not allowed to browse the requested content."))
         return HttpResponseRedirect(LOGIN_REDIRECT_URL)
     try:
-        support = open(support_path).read()
-    except IOError:
+        support = contenus.lit(support_path)
+    except (IOError, OSError):
         if settings.DEBUG:
             support = "Unable to open file %s" % support_path
         else:
@@ -98,7 +98,7 @@ def render_swf(request, c, base, contents_prefix):
                             c.ressource)
     support_path = os.path.join(settings.PROJECT_PATH, suffixe)
     base = os.path.join(base, suffixe)
-    if not include_is_allowed(support_path):
+    if not is_allowed(support_path):
         request.user.message_set.create(
                 message=_("You are not allowed to browse the requested content."))
         return HttpResponseRedirect(LOGIN_REDIRECT_URL)
@@ -111,8 +111,47 @@ def render_swf(request, c, base, contents_prefix):
                                 }, context_instance=RequestContext(request))
 
 def render_any(request, c, base, contents_prefix):
-    return HttpResponseRedirect("/%s/%s/%s/autres/%s" %
-                    (contents_prefix,c.module.slug, c.langue, c.ressource))
+    """
+    Send any other support (pdf...) as a file
+    """
+    support_path = os.path.join(settings.PROJECT_PATH, contents_prefix,
+            c.module.slug, c.langue, 'autres', c.ressource)
+    try:
+        return sert_fichier(request, support_path)
+    except Http404:
+        request.user.message_set.create(
+                message=_("Requested content does not exist"))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+
+@login_required
+def fichier(request, contenu_id):
+    """
+    Download course content file (swf, pdf...).
+    """
+    try:
+        contenu = Contenu.objects.select_related('module').get(pk=contenu_id)
+    except Contenu.DoesNotExist:
+        request.user.message_set.create(
+                message=_("Requested content does not exist"))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    if not UserModule(request.user, contenu.module).is_open():
+        request.user.message_set.create(
+                message=_("Requested content is not allowed."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    contents_prefix = getattr(settings, 'CONTENTS_PREFIX', 'contents')
+    repertoire = {'htm': '', 'swf': 'flash'}.get(contenu.type, 'autres')
+    support_path = os.path.join(settings.PROJECT_PATH, contents_prefix,
+            contenu.module.slug, contenu.langue, repertoire, contenu.ressource)
+    if contenu.type == 'htm' and not is_allowed(support_path):
+        request.user.message_set.create(
+                message=_("You are not allowed to browse the requested content."))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
+    try:
+        return sert_fichier(request, support_path)
+    except Http404:
+        request.user.message_set.create(
+                message=_("Requested content does not exist"))
+        return HttpResponseRedirect(LOGIN_REDIRECT_URL)
 
 @login_required
 def tabcours(request):
@@ -151,73 +190,27 @@ def assignment(request, work_id=None):
         f = WorkForm(request.POST, request.FILES)
         if f.is_valid():
             if f.cleaned_data['fichier']:
-                import sha
-                import zipfile
                 fichier = ''.join(('g%d-' % request.user.groupe.id,
                             request.user.username,'-',
                             datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
                             os.path.splitext(f.cleaned_data['fichier'].name)[1]))
                 fichier = fichier.encode('iso-8859-1')
-                content = request.FILES['fichier']
-                signature = sha.new(content.read()).hexdigest()
                 date = datetime.datetime.now()
                 # try: si le devoir existe, pas de sauvegarde.
                 try:
                     wd = WorkDone.objects.get(utilisateur=request.user, work=work)
                 except WorkDone.DoesNotExist:
+                    content = FichierSigne(request.FILES['fichier'])
                     wd = WorkDone(
                             utilisateur=request.user, 
                             work=work, 
-                            date=date, 
-                            fichier=fichier, 
-                            signature=signature)
-                    wd.fichier.save(fichier, content, save=True)
-                    # groupe-cours zipfile
-                    zfichier = 'g%d-%s.zip' % (request.user.groupe.id,
-                            work.cours.slug)
-                    try:
-                        zf = zipfile.ZipFile(
-                            os.path.join(settings.MEDIA_ROOT,
-                                        settings.WORKDONE_DIR,zfichier),
-                                        'a',zipfile.ZIP_DEFLATED)
-                    except IOError:
-                        zf = zipfile.ZipFile(
-                            os.path.join(settings.MEDIA_ROOT,
-                                        settings.WORKDONE_DIR,zfichier),
-                                        'w',zipfile.ZIP_DEFLATED)
-                    zf.write(os.path.join(settings.MEDIA_ROOT,
-                                    settings.WORKDONE_DIR,fichier))
-                    zf.close()
-                    # login zipfile
-                    zfichier = ''.join(('g%d' % request.user.groupe.id,'-', 
-                                        request.user.username,
-                                        '.zip'))
-                    try:
-                        zf = zipfile.ZipFile(
-                            os.path.join(settings.MEDIA_ROOT,
-                                        settings.WORKDONE_DIR,zfichier),
-                                        'a',zipfile.ZIP_DEFLATED)
-                    except IOError:
-                        zf = zipfile.ZipFile(
-                            os.path.join(settings.MEDIA_ROOT,
-                                        settings.WORKDONE_DIR,zfichier),
-                                        'w',zipfile.ZIP_DEFLATED)
-                    zf.write(os.path.join(settings.MEDIA_ROOT,
-                            settings.WORKDONE_DIR,fichier))
-                    zf.close()
-                    request.user.nb_travaux_rendus += 1
-                    # cours validé ?
-                    uc = UserCours(request.user, request.user.current)
-                    if uc.valide:
-                        request.user.nb_cours_valides += 1
-                        # nouveau cours, raz nb_modules et nb_valides
-                        request.user.nb_modules = None
-                        request.user.nb_valides = 0
-                        try:
-                            request.user.current = uc.liste_cours[uc.rang+1]
-                        except IndexError:
-                            pass
-                    request.user.save()
+                            date=date)
+                    wd.fichier.save(fichier, content, save=False)
+                    signature = content.hexdigest()
+                    wd.signature = signature
+                    # progression et compteurs : voir les signaux de WorkDone
+                    wd.save()
+                    rafraichit_progression(request.user)
                     return render_to_response('learning/assignment.html',{
                              'work': work,
                              'fichier': fichier,
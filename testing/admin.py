@@ -3,7 +3,19 @@
 from django.contrib import admin
 from django import forms
 from django.forms import ModelForm, Textarea
+from django.utils.translation import ugettext as _
 from testing.models import Granule, GranuleTitre, Enonce, Question, Reponse
+from testing import expressions
+
+def verifie_formules(sources):
+    """
+    Lève ValidationError si une des formules rnd est refusée
+    """
+    try:
+        for source in sources:
+            expressions.compile_expression(source)
+    except expressions.ExpressionInvalide, e:
+        raise forms.ValidationError(_("Invalid formula: %s") % e)
 
 class GranuleAdmin(admin.ModelAdmin):
     ordering = ['slug'] 
@@ -23,7 +35,21 @@ class EnonceAdmin(admin.ModelAdmin):
     list_display = ('id','libel')
 admin.site.register(Enonce, EnonceAdmin)
 
+class QuestionForm(forms.ModelForm):
+    class Meta:
+        model = Question
+
+    def clean(self):
+        libel = self.cleaned_data.get('libel')
+        if self.cleaned_data.get('typq') == 'rnd' and libel:
+            try:
+                verifie_formules(expressions.decoupe_libel(libel))
+            except expressions.ExpressionInvalide, e:
+                raise forms.ValidationError(_("Invalid formula: %s") % e)
+        return self.cleaned_data
+
 class QuestionAdmin(admin.ModelAdmin):
+    form = QuestionForm
     search_fields = ['libel','enonce__libel','id','enonce__id',]
     list_display = ('enonce_id','id','libel')
     list_display_links = ('id',)
@@ -53,6 +79,14 @@ class ReponseForm(forms.ModelForm):
         model = Reponse
         widgets = {'valeur': Textarea(attrs={'cols': 80, 'rows': 2}),}
 
+    def clean(self):
+        valeur = self.cleaned_data.get('valeur')
+        question_id = self.instance.question_id
+        if valeur and question_id and Question.objects.filter(
+                id=question_id, typq='rnd').exists():
+            verifie_formules([valeur])
+        return self.cleaned_data
+
 class ReponseAdmin(admin.ModelAdmin):
     form = ReponseForm
     search_fields = ['valeur','question__libel','question__id',
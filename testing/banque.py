@@ -0,0 +1,104 @@
+# -*- encoding: utf-8 -*-
+"""
+Banques de questions compilées.
+
+Pour une granule et une langue, la banque contient toutes les questions
+avec leur énoncé et leurs réponses. Elle est construite en deux requêtes
+et conservée dans le cache Django ; les signaux de Enonce, Question et
+Reponse l'invalident (voir testing.models).
+"""
+
+from django.core.cache import cache
+
+from testing.models import Enonce, Question, Reponse
+
+# durée de vie d'une banque dans le cache (secondes)
+DUREE = 60*60*24
+
+class ReponseCompilee(object):
+    """
+    Réponse d'une question compilée
+    """
+    def __init__(self, r):
+        self.id = r.id
+        self.points = r.points
+        self.valeur = r.valeur
+
+    def __unicode__(self):
+        return self.valeur
+
+class QuestionCompilee(object):
+    """
+    Question compilée : champs de Question, énoncé et réponses
+    """
+    def __init__(self, q, reponses):
+        self.id = q.id
+        self.granule_id = q.granule_id
+        self.langue = q.langue
+        self.typq = q.typq
+        self.libel = q.libel
+        self.enonce_id = q.enonce_id
+        self.enonce_libel = q.enonce.libel
+        self.reponses = [ReponseCompilee(r) for r in reponses]
+
+class Banque(object):
+    """
+    Banque de questions d'une granule dans une langue
+    """
+    def __init__(self, granule_id, langue):
+        self.granule_id = granule_id
+        self.langue = langue
+        questions = list(Question.objects.filter(granule=granule_id,
+                langue=langue).select_related('enonce').order_by('id'))
+        reponses = {}
+        if questions:
+            for r in Reponse.objects.filter(
+                    question__in=[q.id for q in questions]).order_by('id'):
+                reponses.setdefault(r.question_id, []).append(r)
+        self.questions = dict((q.id, QuestionCompilee(q, reponses.get(q.id, [])))
+                for q in questions)
+        self.ids = [q.id for q in questions]
+
+    def tirage(self, nb):
+        """
+        Tire au hasard nb questions (toutes s'il y en a moins)
+        """
+        import random
+        ids = random.sample(self.ids, min(nb, len(self.ids)))
+        return [self.questions[i] for i in ids]
+
+def cle(granule_id, langue):
+    return 'banque.%s.%s' % (granule_id, langue)
+
+def banque(granule_id, langue):
+    """
+    Renvoie la Banque de la granule pour la langue, depuis le cache
+    ou construite si elle n'y est pas
+    """
+    b = cache.get(cle(granule_id, langue))
+    if b is None:
+        b = Banque(granule_id, langue)
+        cache.set(cle(granule_id, langue), b, DUREE)
+    return b
+
+def invalide(instance):
+    """
+    Invalide les banques touchées par la modification ou la suppression
+    d'un Enonce, d'une Question ou d'une Reponse ; pour une Question,
+    aussi la banque d'origine (voir testing.models.memorise_banque)
+    """
+    if isinstance(instance, Question):
+        touchees = [(instance.granule_id, instance.langue)]
+        origine = getattr(instance, '_banque_origine', None)
+        if origine:
+            touchees.append(origine)
+    elif isinstance(instance, Reponse):
+        touchees = Question.objects.filter(
+                id=instance.question_id).values_list('granule', 'langue')
+    elif isinstance(instance, Enonce):
+        touchees = Question.objects.filter(
+                enonce=instance).values_list('granule', 'langue')
+    else:
+        return
+    for granule_id, langue in set(touchees):
+        cache.delete(cle(granule_id, langue))
@@ -1,23 +1,32 @@
 # -*- encoding: utf-8 -*-
 
 import sys
+import logging
 
 from django.utils.translation import ugettext as _
 from django.core.cache import cache
 from django.http import HttpResponseRedirect
+from django.db import transaction
 
-from testing.models import Question
+from testing.models import Granule, Question, Reponse
+from testing.banque import banque
 from coaching.models import GranuleValide, ModuleValide, Resultat
+from learning.progress import differe_progression, applique_progression, \
+        rafraichit_progression
 
-import finance
+import expressions
+
+# questions rnd dont la formule ne peut être évaluée
+logger = logging.getLogger('testing.controllers')
 
 class UserGranule(object):
     """
     Controller d'une granule de test pour un utilisateur
     """
-    def __init__(self, user, granule):
+    def __init__(self, user, granule, progress=None):
         self.user = user
         self.granule = granule
+        self.progress = progress
         self.get_absolute_url = self.granule.get_absolute_url()
         self._date_validation = -1
         self._resultats = -1
@@ -27,20 +36,26 @@ class UserGranule(object):
         return self.granule.titre(self.user.langue)
 
     def resultats(self):
+        """
+        Liste des (score, date) des essais, meilleur score en premier
+        """
         if self._resultats == -1:
-            self._resultats = Resultat.objects.filter(
+            if self.progress:
+                self._resultats = self.progress.resultats(self.granule)
+                return self._resultats
+            self._resultats = list(Resultat.objects.filter(
                     utilisateur=self.user,
-                    granule=self.granule).order_by('-score')
+                    granule=self.granule).order_by('-score').values_list(
+                    'score', 'date'))
         return self._resultats
 
     def perfs(self):
         if not self._perfs:
             resultats = self.resultats()
             if resultats:
-                nb_tries = resultats.count()
-                best_score = resultats[0].score
+                nb_tries = len(resultats)
+                best_score, best_score_date = resultats[0]
                 str_best_score = "%2d %%" % best_score
-                best_score_date = resultats[0].date
             else:
                 nb_tries = 0
                 best_score = 0
@@ -67,6 +82,10 @@ class UserGranule(object):
         False s'il n'est pas validé
         """
         if self._date_validation == -1:
+            if self.progress:
+                self._date_validation = \
+                        self.progress.date_granule(self.granule)
+                return self._date_validation
             try:
                 v = GranuleValide.objects.get(utilisateur=self.user,
                                                 granule=self.granule)
@@ -97,34 +116,42 @@ class UserTest(object):
         """
         Retourne le code html des énoncés du test, avec leurs questions
         """
-        questions = \
-            Question.objects.filter(granule=self.granule, 
-                    langue=self.langue).order_by('?')[:self.granule.nbq]
+        questions = banque(self.granule.id, self.langue).tirage(
+                self.granule.nbq)
         if not questions:
             self.langue = 'fr'
-            questions = \
-                Question.objects.filter(granule=self.granule, 
-                        langue='fr').order_by('?')[:self.granule.nbq]
+            questions = banque(self.granule.id, 'fr').tirage(
+                    self.granule.nbq)
             self.user.message_set.create(
                 message=_('We are sorry, this content is not available in your preferred language.'))
         enonces = {}
         for q in questions:
-            enonces.setdefault(q.enonce.id,{})
-            enonces[q.enonce.id]['libel'] = q.enonce.libel
-            if not 'questions' in enonces[q.enonce.id]:
-                enonces[q.enonce.id]['questions'] = []
-            enonces[q.enonce.id]['questions'].append(
-                    getattr(self, "_output_%s" % q.typq)(q))
+            output = getattr(self, "_output_%s" % q.typq)(q)
+            if output is None:
+                continue
+            enonces.setdefault(q.enonce_id,{})
+            enonces[q.enonce_id]['libel'] = q.enonce_libel
+            if not 'questions' in enonces[q.enonce_id]:
+                enonces[q.enonce_id]['questions'] = []
+            enonces[q.enonce_id]['questions'].append(output)
         return enonces.values()
 
     def _output_rnd(self, question):
-        import random
-        phrase, dico = question.libel.split(" % ")
-        phrase = eval(phrase)
-        dico = eval(dico)
-        phrase = phrase % dico
+        """
+        None si la formule de la question ne peut être évaluée :
+        la question n'est pas posée
+        """
+        try:
+            phrase, dico = expressions.question_rnd(question)
+            dico = expressions.evalue(dico)
+            phrase = expressions.evalue(phrase) % dico
+        except (ValueError, KeyError, TypeError), e:
+            logger.error('rnd question %s skipped: %s', question.id, e)
+            return None
         rep = self.REP % question.id
-        hidden = self.HID_DICT % (dico,question.id)
+        hidden = self.HID_DICT % (
+                expressions.signe(question.id, self.user.id, dico),
+                question.id)
         return " ".join((phrase,rep,hidden))
 
     def _output_exa(self, question):
@@ -132,25 +159,25 @@ class UserTest(object):
         return question.libel.replace("<REPONSE>",rep)
 
     def _output_num(self, question):
-        return self.output_exa(question)
+        return self._output_exa(question)
 
     def _output_qrm(self, question):
         if sys.version_info[1]==3:
             reponses = '\n'.join([self.CHECK % (r.id, question.id, r)
-                                for r in question.reponse_set.all()])
+                                for r in question.reponses])
         else:
             reponses = '\n'.join([self.CHECK % (r.id, question.id, r.valeur)
-                                for r in question.reponse_set.all()])
+                                for r in question.reponses])
         hidden = self.HID_REP % question.id
         return '\n'.join((question.libel,hidden,reponses))
 
     def _output_qcm(self, question):
         if sys.version_info[1]==3:
             reponses = '\n'.join( [self.RADIO % (r.id, question.id, r)
-                                for r in question.reponse_set.all()])
+                                for r in question.reponses])
         else:
             reponses = '\n'.join( [self.RADIO % (r.id, question.id, r.valeur)
-                                for r in question.reponse_set.all()])
+                                for r in question.reponses])
         hidden = self.HID_REP % question.id
         return '\n'.join((question.libel,hidden,reponses))
 
@@ -179,7 +206,7 @@ class UserSubmittedTest(object):
     def _noter_exa(self, q, rep):
         rep = rep[-1]
         qd = self._set_qd(q, rep)
-        r = q.reponse_set.all()[0]
+        r = q.reponses[0]
         self.max += r.points
         if rep:
             rep = self._clean(rep).replace(',','.').rstrip('0')
@@ -196,7 +223,7 @@ class UserSubmittedTest(object):
     def _noter_num(self, q, rep):
         rep = rep[-1]
         qd = self._set_qd(q, rep)
-        r = q.reponse_set.all()[0]
+        r = q.reponses[0]
         self.max += r.points
         # seuls les chiffres avant le séparateur décimal sont significatifs
         rep = rep.replace('%','')
@@ -212,15 +239,25 @@ class UserSubmittedTest(object):
     def _noter_rnd(self, q, rep):
         rep = rep[-1]
         qd = self._set_qd(q, rep)
-        r = q.reponse_set.all()[0]
+        r = q.reponses[0]
+        try:
+            dico = expressions.verifie(q.id, self.user.id,
+                    self.request.POST.get('dic%d' % q.id, ''))
+        except expressions.SignatureInvalide:
+            self.max += r.points
+            qd['points'] = '0'
+            return qd
+        try:
+            phrase = expressions.question_rnd(q)[0]
+            qd['libel'] = expressions.evalue(phrase) % dico
+            r.valeur = '%f' % expressions.evalue(
+                    expressions.reponse_rnd(r), dico)
+        except (ValueError, KeyError, TypeError), e:
+            # formule invalide : la question ne compte pas
+            logger.error('rnd question %s not graded: %s', q.id, e)
+            qd['points'] = '0'
+            return qd
         self.max += r.points
-        phrase, dico = q.libel.split(" % ")
-        dico = ''.join(('dic',str(q.id)))
-        dico = eval(self.request.POST[dico])
-        qd['libel'] = eval(phrase) % dico
-        for k,v in dico.items():
-            locals()[k] = v
-        r.valeur = '%f' % eval(r.valeur)
         if rep:
             rep = self._clean(rep).replace(',','.').rstrip('0')
             r.valeur = self._clean(r.valeur).replace(',','.').rstrip('0')
@@ -237,7 +274,7 @@ class UserSubmittedTest(object):
     def _noter_qcm(self, q, rep):
         rep = rep[-1]
         qd = self._set_qd(q, rep)
-        for r in q.reponse_set.all():
+        for r in q.reponses:
             if int(rep) == r.id:
                 self.total += r.points
                 qd['points'] = r.points
@@ -254,7 +291,7 @@ class UserSubmittedTest(object):
         qd = {}
         qd['libel'] = q.libel.replace("<REPONSE>","...")
         qd['reponse'] = ''
-        for r in q.reponse_set.all():
+        for r in q.reponses:
             for rr in rep:
                 if int(rr) == r.id:
                     self.total += r.points
@@ -271,20 +308,40 @@ class UserSubmittedTest(object):
             qd['reponse'] = _('nothing')
         return qd
 
-    def noter(self):
+    def _questions(self):
         """
-        Note le test
-        Retourne un tuple (score, score_max, validé ?)
+        Renvoie la liste des (question, réponse soumise) du POST.
+        Les questions, leurs énoncés, granules et réponses sont
+        chargés en deux requêtes.
         """
-        from learning.controllers import UserCours
-        enonces = {}
+        soumises = {}
         for quest,rep in self.request.POST.lists():
             if not quest.startswith('rep'):
                 continue
             try:
-                q = Question.objects.get(id=quest.replace('rep',''))
-            except Question.DoesNotExist:
+                soumises[int(quest.replace('rep',''))] = rep
+            except ValueError:
                 continue
+        if not soumises:
+            return []
+        questions = list(Question.objects.filter(
+                id__in=soumises.keys()).select_related('enonce', 'granule'))
+        reponses = {}
+        for r in Reponse.objects.filter(
+                question__in=soumises.keys()).order_by('id'):
+            reponses.setdefault(r.question_id, []).append(r)
+        for q in questions:
+            q.reponses = reponses.get(q.id, [])
+        return [(q, soumises[q.id]) for q in questions]
+
+    def noter(self):
+        """
+        Note le test
+        Retourne un tuple (score, score_max, validé ?)
+        """
+        enonces = {}
+        questions = self._questions()
+        for q, rep in questions:
             enonces.setdefault(q.enonce.id,{})
             enonces[q.enonce.id]['libel'] = q.enonce.libel
             if not 'questions' in enonces[q.enonce.id]:
@@ -298,15 +355,33 @@ class UserSubmittedTest(object):
             score = round(float(self.total)/self.max*100)
         except ZeroDivisionError:
             score = 0
-        try:
-            g = q.granule
-        except UnboundLocalError:
+        if not questions:
             return HttpResponseRedirect('/')
+        g = questions[-1][0].granule
         self.titre = g.titre(self.user.langue)
         self.get_absolute_url = g.get_absolute_url()
+        self.valide = score >= g.score_min
+        # un seul recalcul de progression, après la transaction
+        differe_progression()
+        try:
+            self._enregistre(g, score)
+        finally:
+            applique_progression()
+        rafraichit_progression(self.user)
+        self.enonces = enonces.values()
+        return
+
+    @transaction.commit_on_success
+    def _enregistre(self, g, score):
+        """
+        Enregistre le résultat, et les validations de la granule,
+        du module et du cours, en une transaction.
+        La progression et les compteurs de l'utilisateur sont mis à jour
+        par les signaux de GranuleValide et ModuleValide (différés
+        jusqu'à la fin de la transaction, voir noter).
+        """
         r = Resultat(utilisateur=self.user, granule=g, score=score)
         r.save()
-        self.valide = score >= q.granule.score_min
         if self.valide:
             # si déjà validé, on conserve l'ancien score
             try:
@@ -319,40 +394,18 @@ class UserSubmittedTest(object):
                         granule=g,
                         score=score)
                 gv.save()
-            mvalide = True
-            for gr in g.module.granule_set.all():
-                if self.user.granulevalide_set.filter(granule=gr).count() == 0:
-                    mvalide = False
-                    break
+            # module validé si aucune de ses granules ne reste à valider
+            mvalide = not Granule.objects.filter(module=g.module_id).exclude(
+                    id__in=GranuleValide.objects.filter(
+                        utilisateur=self.user).values('granule')).count()
             if mvalide:
-#                modules_key = \
-#                        "Utilisateur.%s.liste_modules_autorises" % self.user.id
-#                cache.delete(modules_key)
-#                cours_key = "Utilisateur.%s.liste_cours_ouverts" % self.user.id
-#                cache.delete(cours_key)
                 # si module déjà validé on ne fait rien
                 try:
                     ModuleValide.objects.get(
                             utilisateur=self.user,
-                            module=g.module)
+                            module=g.module_id)
                 except ModuleValide.DoesNotExist:
                     mv = ModuleValide(
                             utilisateur=self.user,
-                            module=g.module)
+                            module_id=g.module_id)
                     mv.save()
-                    self.user.nb_valides +=1
-                    # module validé, est-ce que ça valide le cours ?
-                    uc = UserCours(self.user, self.user.current)
-                    if uc.valide:
-                        self.user.nb_cours_valides += 1
-                        # nouveau cours, raz nb_modules et nb_valides
-                        self.user.nb_modules = None
-                        self.user.nb_valides = 0
-                        try:
-                            self.user.current = uc.liste_cours[uc.rang+1]
-                        except IndexError:
-                            pass
-            self.user.save()
-
-        self.enonces = enonces.values()
-        return 
@@ -0,0 +1,173 @@
+# -*- encoding: utf-8 -*-
+"""
+Expressions des questions aléatoires (typq 'rnd').
+
+Le libellé d'une question rnd est de la forme "<phrase> % <dico>" et la
+valeur de sa réponse est une expression calculée avec les variables du
+dico. Ces expressions sont analysées une seule fois, vérifiées (seuls
+les opérateurs, littéraux, variables et fonctions autorisés sont
+acceptés) puis compilées ; les formes compilées sont conservées en
+mémoire par question ou réponse.
+
+Les variables tirées pour une question sont renvoyées au navigateur
+signées pour l'utilisateur, et la signature est vérifiée à la correction.
+Une expression refusée ou dont l'évaluation échoue lève
+ExpressionInvalide ; les formulaires de l'admin la refusent à
+l'enregistrement (voir testing.admin).
+"""
+
+import ast
+import base64
+import math
+import random
+
+from django.utils import simplejson
+from django.utils.crypto import salted_hmac, constant_time_compare
+
+import finance
+
+class ExpressionInvalide(ValueError):
+    """
+    Expression refusée, syntaxiquement incorrecte ou dont
+    l'évaluation échoue
+    """
+    pass
+
+class SignatureInvalide(ValueError):
+    """
+    Variables renvoyées par le navigateur altérées ou illisibles
+    """
+    pass
+
+class Espace(object):
+    """
+    Espace de noms restreint (remplace un module dans les expressions)
+    """
+    def __init__(self, **fonctions):
+        self.__dict__.update(fonctions)
+
+ESPACES = {
+    'random': Espace(randint=random.randint, randrange=random.randrange,
+        uniform=random.uniform, choice=random.choice, random=random.random,
+        sample=random.sample, gauss=random.gauss),
+    'math': Espace(**dict((nom, getattr(math, nom)) for nom in dir(math)
+        if not nom.startswith('_'))),
+    'finance': Espace(npv=finance.npv, irr=finance.irr, ytm=finance.ytm),
+}
+
+GLOBALS = {
+    '__builtins__': {},
+    'True': True, 'False': False, 'None': None,
+    'abs': abs, 'round': round, 'min': min, 'max': max, 'sum': sum,
+    'len': len, 'int': int, 'float': float, 'range': range,
+    'pow': pow, 'divmod': divmod, 'long': long, 'bool': bool, 'str': str,
+    'list': list, 'tuple': tuple, 'dict': dict, 'map': map, 'zip': zip,
+    'sorted': sorted, 'reversed': reversed, 'enumerate': enumerate,
+}
+GLOBALS.update(ESPACES)
+
+NOEUDS = (ast.Expression, ast.Num, ast.Str, ast.Name, ast.expr_context,
+        ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+        ast.operator, ast.unaryop, ast.boolop, ast.cmpop,
+        ast.Call, ast.keyword, ast.Attribute, ast.List, ast.Tuple, ast.Dict,
+        ast.Subscript, ast.Index, ast.Slice, ast.ListComp, ast.comprehension)
+
+_compilees = {}
+
+def compile_expression(source):
+    """
+    Analyse, vérifie et compile l'expression source.
+    Lève ExpressionInvalide si elle n'est pas acceptée.
+    """
+    try:
+        arbre = ast.parse(source.strip(), mode='eval')
+    except SyntaxError, e:
+        raise ExpressionInvalide(str(e))
+    for noeud in ast.walk(arbre):
+        if not isinstance(noeud, NOEUDS):
+            raise ExpressionInvalide(
+                    "%s not allowed" % noeud.__class__.__name__)
+        if isinstance(noeud, ast.Name) and noeud.id.startswith('_'):
+            raise ExpressionInvalide("name %s not allowed" % noeud.id)
+        if isinstance(noeud, ast.Attribute):
+            if not isinstance(noeud.value, ast.Name) \
+                    or noeud.value.id not in ESPACES \
+                    or noeud.attr.startswith('_') \
+                    or not hasattr(ESPACES[noeud.value.id], noeud.attr):
+                raise ExpressionInvalide(
+                        "attribute %s not allowed" % noeud.attr)
+    return compile(arbre, '<expression>', 'eval')
+
+def expression(cle, source):
+    """
+    Renvoie la forme compilée de source, depuis le cache si possible.
+    cle identifie l'objet (('q', question.id) par ex.) ; la source fait
+    partie de la clé, une modification du libellé est donc prise en compte.
+    """
+    if (cle, source) not in _compilees:
+        _compilees[(cle, source)] = compile_expression(source)
+    return _compilees[(cle, source)]
+
+def evalue(code, variables=None):
+    """
+    Evalue une expression compilée avec les variables données.
+    Lève ExpressionInvalide si l'évaluation échoue.
+    """
+    try:
+        return eval(code, GLOBALS, dict(variables or {}))
+    except Exception, e:
+        raise ExpressionInvalide('%s: %s' % (e.__class__.__name__, e))
+
+def decoupe_libel(libel):
+    """
+    Renvoie (phrase, dico) sources du libellé d'une question rnd
+    """
+    try:
+        phrase, dico = libel.split(" % ", 1)
+    except ValueError:
+        raise ExpressionInvalide("' % ' missing between sentence and dict")
+    return phrase, dico
+
+def question_rnd(question):
+    """
+    Renvoie (phrase, dico) compilés pour le libellé de la question
+    """
+    phrase, dico = decoupe_libel(question.libel)
+    return (expression(('q', question.id, 'phrase'), phrase),
+            expression(('q', question.id, 'dico'), dico))
+
+def reponse_rnd(reponse):
+    """
+    Renvoie la valeur compilée de la réponse
+    """
+    return expression(('r', reponse.id), reponse.valeur)
+
+def _signature(question_id, user_id, donnees):
+    return salted_hmac('testing.expressions.%s.%s' % (question_id, user_id),
+            donnees).hexdigest()
+
+def signe(question_id, user_id, variables):
+    """
+    Renvoie les variables de la question sérialisées et signées
+    pour l'utilisateur
+    """
+    donnees = base64.urlsafe_b64encode(simplejson.dumps(variables))
+    return '%s:%s' % (donnees, _signature(question_id, user_id, donnees))
+
+def verifie(question_id, user_id, valeur):
+    """
+    Renvoie les variables signées par signe() pour l'utilisateur.
+    Lève SignatureInvalide si elles ont été altérées ou signées pour
+    un autre utilisateur.
+    """
+    try:
+        donnees, signature = str(valeur).rsplit(':', 1)
+    except (ValueError, UnicodeError):
+        raise SignatureInvalide(valeur)
+    if not constant_time_compare(signature,
+            _signature(question_id, user_id, donnees)):
+        raise SignatureInvalide(valeur)
+    try:
+        return simplejson.loads(base64.urlsafe_b64decode(donnees))
+    except (TypeError, ValueError):
+        raise SignatureInvalide(valeur)
@@ -1,6 +1,11 @@
 # -*- encoding: utf-8 -*-
 """
 Financial functions
+
+npv, irr and ytm work on one cash flows vector.
+npv_many, irr_many and ytm_many work on many vectors at once, with
+NumPy arrays when NumPy is installed (plain loops otherwise) ; they
+return lists in both cases.
 """
 
 __author__ = "Jean-Charles Bagneris <jcb@bagneris.net>"
@@ -8,6 +13,11 @@ __license__ = "BSD"
 
 import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def npv(rate, cashflows):
     """
     Return NPV (float)
@@ -15,16 +25,72 @@ def npv(rate, cashflows):
     cashflows : cash flows, iterable
     """
     npv = 0
-    rate = rate/100.
-    for year,cf in enumerate(cashflows):
-        npv += cf/(1+rate)**year
+    facteur = 1.
+    v = 1/(1+rate/100.)
+    for cf in cashflows:
+        npv += cf*facteur
+        facteur *= v
     return npv
 
+def _npv_derivative(rate, cashflows):
+    """
+    Return (NPV, dNPV/drate), rate in %
+    """
+    npv = deriv = 0
+    v = 1/(1+rate/100.)
+    facteur = 1.
+    for year, cf in enumerate(cashflows):
+        npv += cf*facteur
+        deriv -= year*cf*facteur*v
+        facteur *= v
+    return npv, deriv/100.
+
+def _sign_changes(cashflows):
+    """
+    Return the number of sign changes of the cash flows (zeros ignored)
+    """
+    signs = [cf > 0 for cf in cashflows if cf]
+    return len([1 for a, b in zip(signs, signs[1:]) if a != b])
+
 def irr(cashflows, precision=10**-4, maxrate=10**6):
     """
-    Return IRR (float) in %
+    Return IRR (float) in %, between 0 and maxrate
     cashflows : cash flows, iterable
     precision : float
+    Newton steps, falling back to bisection when a step leaves
+    the bracketing interval.
+    Cash flows changing sign more than once may have several IRRs :
+    they go through irr_bisection, which picks the same one as before.
+    """
+    cashflows = list(cashflows)
+    if _sign_changes(cashflows) > 1:
+        return irr_bisection(cashflows, precision, maxrate)
+    binf, bsup = 0., float(maxrate)
+    if npv(binf, cashflows) <= 0:
+        return binf
+    if npv(bsup, cashflows) >= 0:
+        return bsup
+    rate = min(10., bsup/2.)
+    while True:
+        f, df = _npv_derivative(rate, cashflows)
+        if f > 0:
+            binf = rate
+        else:
+            bsup = rate
+        if df < 0:
+            suivant = rate - f/df
+        else:
+            suivant = binf - 1
+        if not binf < suivant < bsup:
+            suivant = (binf+bsup)/2.
+        if abs(suivant - rate) < precision or bsup - binf < precision:
+            return suivant
+        rate = suivant
+
+def irr_bisection(cashflows, precision=10**-4, maxrate=10**6):
+    """
+    Return IRR (float) in %, by bisection only.
+    Former irr implementation, kept as a reference for bench().
     """
     binf, bsup = 0, maxrate
     while bsup - binf > precision:
@@ -35,6 +101,9 @@ def irr(cashflows, precision=10**-4, maxrate=10**6):
             binf = irr
     return irr
 
+def _bond_cashflows(emission, coupon, rembt, duree):
+    return [-emission] + [coupon]*(duree-1) + [coupon+rembt]
+
 def ytm(emission,coupon,rembt,duree):
     """
     Return YTM of bond (float) in %
@@ -44,18 +113,128 @@ def ytm(emission,coupon,rembt,duree):
     duree : duration (years)
     WARNING - coupons are supposed to be paid yearly
     """
-    cf = [-emission]
-    for i in range(duree-1):
-        cf.append(coupon)
-    cf.append(coupon+rembt)
-    print cf
-    return irr(cf)
+    return irr(_bond_cashflows(emission, coupon, rembt, duree))
 
+def _matrix(cashflows):
+    """
+    Return cash flows vectors as a 2d array, shorter vectors
+    padded with zeros
+    """
+    cashflows = [list(cf) for cf in cashflows]
+    longueur = max([len(cf) for cf in cashflows] or [0])
+    return numpy.array([cf + [0.]*(longueur-len(cf)) for cf in cashflows],
+            dtype=float)
+
+def _npv_matrix(rates, cf):
+    """
+    Return NPVs of each row of the 2d array cf at each rate, as an array
+    """
+    v = 1/(1+numpy.asarray(rates, dtype=float)/100.)
+    facteurs = v[:, numpy.newaxis] ** numpy.arange(cf.shape[1])
+    return numpy.dot(cf, facteurs.T)
+
+def npv_many(rates, cashflows):
+    """
+    Return NPVs of each cash flows vector at each rate,
+    as a len(cashflows) x len(rates) list of lists
+    rates : discount rates, in %
+    cashflows : iterable of cash flows vectors
+    """
+    cashflows = [list(cf) for cf in cashflows]
+    if numpy is None or not cashflows:
+        return [[npv(rate, cf) for rate in rates] for cf in cashflows]
+    return _npv_matrix(rates, _matrix(cashflows)).tolist()
+
+def irr_many(cashflows, precision=10**-4, maxrate=10**6):
+    """
+    Return IRRs (in %, between 0 and maxrate) of each cash flows vector,
+    as a list
+    cashflows : iterable of cash flows vectors
+    Same Newton / bisection scheme as irr, run on all vectors at once ;
+    vectors changing sign more than once go through irr_bisection.
+    """
+    cashflows = [list(cf) for cf in cashflows]
+    if numpy is None or not cashflows:
+        return [irr(cf, precision, maxrate) for cf in cashflows]
+    cf = _matrix(cashflows)
+    annees = numpy.arange(cf.shape[1])
+    binf = numpy.zeros(cf.shape[0])
+    bsup = numpy.empty(cf.shape[0])
+    bsup.fill(float(maxrate))
+    npv_min = cf.sum(axis=1)
+    npv_max = _npv_matrix([maxrate], cf)[:, 0]
+    rate = numpy.empty(cf.shape[0])
+    rate.fill(min(10., maxrate/2.))
+    actifs = (npv_min > 0) & (npv_max < 0)
+    ancien = numpy.seterr(all='ignore')
+    try:
+        while actifs.any():
+            v = 1/(1+rate[actifs]/100.)
+            facteurs = v[:, numpy.newaxis] ** annees
+            flux = cf[actifs]*facteurs
+            f = flux.sum(axis=1)
+            df = -(flux*annees).sum(axis=1)*v/100.
+            inf = numpy.where(f > 0, rate[actifs], binf[actifs])
+            sup = numpy.where(f > 0, bsup[actifs], rate[actifs])
+            suivant = rate[actifs] - f/df
+            hors = ~numpy.isfinite(suivant) | (df >= 0) \
+                    | (suivant <= inf) | (suivant >= sup)
+            suivant = numpy.where(hors, (inf+sup)/2., suivant)
+            fini = (abs(suivant - rate[actifs]) < precision) \
+                    | (sup - inf < precision)
+            binf[actifs] = inf
+            bsup[actifs] = sup
+            rate[actifs] = suivant
+            actifs[actifs] = ~fini
+    finally:
+        numpy.seterr(**ancien)
+    rate[npv_min <= 0] = 0.
+    rate[(npv_min > 0) & (npv_max >= 0)] = maxrate
+    for i, vecteur in enumerate(cashflows):
+        if _sign_changes(vecteur) > 1:
+            rate[i] = irr_bisection(vecteur, precision, maxrate)
+    return rate.tolist()
+
+def ytm_many(emissions, coupons, rembts, durees):
+    """
+    Return YTMs (in %) of many bonds, as a list
+    Arguments are sequences of the same length, see ytm
+    """
+    return irr_many([_bond_cashflows(*bond) for bond in
+            zip(emissions, coupons, rembts, durees)])
+
+def bench(n=1000):
+    """
+    Compare irr_bisection, irr and irr_many on n random cash flows vectors
+    """
+    import random
+    import time
+    cashflows = [[-random.randint(500, 5000)] +
+                 [random.randint(50, 2000) for i in range(random.randint(2, 10))]
+                 for j in range(n)]
+    resultats = {}
+    for nom, fonction in (
+            ('irr_bisection', lambda: [irr_bisection(cf) for cf in cashflows]),
+            ('irr', lambda: [irr(cf) for cf in cashflows]),
+            ('irr_many', lambda: irr_many(cashflows))):
+        debut = time.time()
+        resultats[nom] = list(fonction())
+        print "%-14s %d vectors : %.4f s" % (nom, n, time.time()-debut)
+    for nom in ('irr', 'irr_many'):
+        ecart = max([abs(a-b) for a, b in
+                zip(resultats[nom], resultats['irr_bisection'])])
+        print "%-14s max difference with irr_bisection : %.6f %%" % (nom, ecart)
+    if numpy is None:
+        print "NumPy is not installed, irr_many uses irr."
 
 def main():
     """
     For testing purposes
+    python finance.py bench : compare the IRR implementations
     """
+    if sys.argv[1:] == ['bench']:
+        bench()
+        return 0
     cashflows = [-2000,1000,1000,500]
     print npv(10, cashflows)
     therate = irr(cashflows)
@@ -65,6 +244,7 @@ def main():
     print "%.4f %%" % therate
     print npv(therate, cashflows)
     print ytm(99,5,100,10)
+    print ytm_many([99, 95], [5, 4], [100, 100], [10, 5])
     return 0
 
 if __name__ == "__main__":
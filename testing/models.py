@@ -1,9 +1,11 @@
 # -*- encoding: utf-8 -*-
 
 from django.db import models
+from django.db.models.signals import post_init, post_save, post_delete
 from django.conf import settings
 
 from learning.models import Module
+from learning.titres import CatalogueTitres
 
 from listes import *
 
@@ -25,16 +27,24 @@ class Granule(models.Model):
         return self.slug
 
     def titre(self, langue):
-        try:
-            gt = self.granuletitre_set.get(langue=langue).titre
-        except GranuleTitre.DoesNotExist:
-            gt = self.slug
-        return gt
+        return titres_granules.titre(self, langue)
 
     @models.permalink
     def get_absolute_url(self):
         return('testing.views.test', [str(self.id)])
 
+
+def marque_progression_granule(sender, instance, **kwargs):
+    """
+    Marque les groupes qui suivent le module pour le recalcul de
+    leur progression (voir learning.progress)
+    """
+    from learning.progress import marque_modules
+    marque_modules([instance.module_id])
+
+post_save.connect(marque_progression_granule, sender=Granule)
+post_delete.connect(marque_progression_granule, sender=Granule)
+
 class GranuleTitre(models.Model):
     """
     Titre d'une granule dans la langue choisie
@@ -50,6 +60,10 @@ class GranuleTitre(models.Model):
     def __unicode__(self):
         return '%s : %s' % (self.granule, self.titre)
 
+titres_granules = CatalogueTitres(GranuleTitre, 'granule')
+post_save.connect(titres_granules.invalide, sender=GranuleTitre)
+post_delete.connect(titres_granules.invalide, sender=GranuleTitre)
+
 class Enonce(models.Model):
     """
     Un énoncé pour un ensemble de questions.
@@ -101,3 +115,23 @@ class Reponse(models.Model):
 
     def enonce(self):
         return self.question.enonce
+
+def invalide_banque(sender, instance, **kwargs):
+    """
+    Invalide les banques de questions compilées (voir testing.banque)
+    """
+    from testing.banque import invalide
+    invalide(instance)
+
+def memorise_banque(sender, instance, **kwargs):
+    """
+    Mémorise la granule et la langue de la question telles que lues
+    en base, pour invalider aussi leur banque (voir testing.banque)
+    """
+    instance._banque_origine = (instance.granule_id, instance.langue)
+
+post_init.connect(memorise_banque, sender=Question)
+for model in (Enonce, Question, Reponse):
+    post_save.connect(invalide_banque, sender=model)
+    post_delete.connect(invalide_banque, sender=model)
+post_save.connect(memorise_banque, sender=Question)
@@ -5,7 +5,6 @@ import os.path
 from django.shortcuts import render_to_response, get_object_or_404
 from django.http import HttpResponseRedirect, HttpResponse
 from django.utils.translation import ugettext as _
-from django.contrib.sites.models import Site
 from django.contrib.auth.decorators import login_required
 from django.template import RequestContext, loader
 from django.conf import settings
@@ -13,6 +12,7 @@ from django.conf import settings
 from testing.models import Granule
 from testing.controllers import UserTest, UserSubmittedTest
 from learning.controllers import UserModule
+from learning.contenus import base_url
 
 LOGIN_REDIRECT_URL = getattr(settings, 'LOGIN_REDIRECT_URL', '/')
 
@@ -36,9 +36,7 @@ def test(request, granule_id=None):
         request.user.message_set.create(
                 message=_("Requested test is not allowed."))
         return HttpResponseRedirect(LOGIN_REDIRECT_URL)
-    site_id = getattr(settings, 'SITE_ID', 1)
-    site = Site.objects.get(id=site_id)
-    base = ''.join(('http://', site.domain))
+    base = base_url()
     contents_prefix = getattr(settings, 'CONTENTS_PREFIX', 'contents')
     suffixe = os.path.join( contents_prefix,
                             granule.module.slug,